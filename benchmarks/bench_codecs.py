@@ -0,0 +1,63 @@
+"""Compare value serialization against the json-only baseline.
+
+Usage:
+    python -m benchmarks.bench_codecs [--num-values N] [--repeats N]
+"""
+import argparse
+import json
+import random
+import timeit
+
+from sqla_eav import codecs
+
+
+def main():
+    args = parse_args()
+    values = generate_values(num_values=args.num_values)
+    cases = {'legacy_json': LegacyCodec()}
+    for codec_name in sorted(codecs.CodecRegistry().codecs):
+        cases[codec_name] = codecs.CodecRegistry(default_codec=codec_name)
+    print('%-12s %12s %12s' % ('codec', 'encode us', 'decode us'))
+    for case_name, registry in cases.items():
+        encoded = [registry.encode(value=value) for value in values]
+        encode_time = min(timeit.repeat(
+            lambda: [registry.encode(value=value) for value in values],
+            number=1, repeat=args.repeats))
+        decode_time = min(timeit.repeat(
+            lambda: [registry.decode(raw_value=raw_value, type_tag=type_tag)
+                     for type_tag, raw_value in encoded],
+            number=1, repeat=args.repeats))
+        print('%-12s %12.3f %12.3f' % (
+            case_name, encode_time / len(values) * 1e6,
+            decode_time / len(values) * 1e6))
+
+class LegacyCodec(object):
+    # The serialization Dao used before the codec registry.
+    def encode(self, value=None):
+        type_ = type(value).__name__
+        if type_ != 'str': value = json.dumps(value)
+        return type_, value
+
+    def decode(self, raw_value=None, type_tag=None):
+        if type_tag and type_tag != 'str': return json.loads(raw_value)
+        return raw_value
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-values', type=int, default=100000)
+    parser.add_argument('--repeats', type=int, default=5)
+    return parser.parse_args()
+
+def generate_values(num_values=None):
+    rand = random.Random(0)
+    generators = [
+        lambda: rand.randint(-10 ** 6, 10 ** 6),
+        lambda: rand.random(),
+        lambda: rand.random() < 0.5,
+        lambda: None,
+        lambda: 'value_%s' % rand.randint(0, 1000),
+        lambda: {'x': rand.random(), 'tags': ['a', 'b']},
+    ]
+    return [rand.choice(generators)() for _ in range(num_values)]
+
+if __name__ == '__main__': main()
@@ -0,0 +1,76 @@
+"""Compare prop filter strategies on multi-filter queries.
+
+Usage:
+    python -m benchmarks.bench_prop_filter_strategies [--db-uri URI] \\
+        [--num-ents N] [--repeats N]
+
+Pass a Postgres URI (e.g. postgresql://user@localhost/bench) to benchmark
+against Postgres; the default is an in-memory SQLite database. Tables in
+the target database are dropped and recreated.
+"""
+import argparse
+import random
+import time
+
+from sqla_eav import dao as _dao
+
+
+QUERIES = {
+    'one_binary': {
+        'prop_filters': [{'prop': 'idx', 'op': '<', 'arg': 100}],
+    },
+    'two_binary': {
+        'prop_filters': [{'prop': 'bucket', 'op': '=', 'arg': 7},
+                         {'prop': 'score', 'op': '>', 'arg': 0.5}],
+    },
+    'binary_and_existence': {
+        'prop_filters': [{'prop': 'score', 'op': '>=', 'arg': 0.9},
+                         {'prop': 'tag', 'op': 'EXISTS'},
+                         {'prop': 'name', 'op': 'LIKE', 'arg': 'name_1%'}],
+    },
+    'paged': {
+        'prop_filters': [{'prop': 'bucket', 'op': '! =', 'arg': 3}],
+        'order_by': [{'prop': 'score', 'type': 'float'}],
+        'limit': 50,
+    },
+}
+
+def main():
+    args = parse_args()
+    dao = _dao.Dao(db_uri=args.db_uri)
+    dao.drop_tables()
+    dao.ensure_tables()
+    populate(dao=dao, num_ents=args.num_ents)
+    print('%-22s %-12s %10s %8s' % ('query', 'strategy', 'ms/query', 'ents'))
+    for query_name, query in QUERIES.items():
+        for strategy in dao.PROP_FILTER_STRATEGIES:
+            elapsed, num_ents = time_query(
+                dao=dao, query={**query, 'prop_filter_strategy': strategy},
+                repeats=args.repeats)
+            print('%-22s %-12s %10.2f %8s' % (query_name, strategy,
+                                              elapsed * 1000, num_ents))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db-uri', default='sqlite://')
+    parser.add_argument('--num-ents', type=int, default=20000)
+    parser.add_argument('--repeats', type=int, default=5)
+    return parser.parse_args()
+
+def populate(dao=None, num_ents=None):
+    rand = random.Random(0)
+    dao.create_ents(ents=(
+        {'key': 'ent_%s' % i,
+         'props': {'idx': i, 'bucket': i % 20, 'score': rand.random(),
+                   'name': 'name_%s' % i,
+                   **({'tag': 'tagged'} if i % 10 == 0 else {})}}
+        for i in range(num_ents)
+    ))
+
+def time_query(dao=None, query=None, repeats=None):
+    dao.query_ents(query=query)
+    start = time.perf_counter()
+    for _ in range(repeats): ents = dao.query_ents(query=query)
+    return (time.perf_counter() - start) / repeats, len(ents)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,80 @@
+"""Compare storage size and read throughput across value compressions.
+
+Usage:
+    python -m benchmarks.bench_value_compression [--num-ents N] \\
+        [--repeats N]
+
+Each configuration loads the same repetitive JSON props into a fresh
+SQLite file, then reports the file size, the bytes held in props.value and
+the time to read every ent back with query_ents.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sqla_eav import dao as _dao
+from sqla_eav.utils import compression_utils
+
+
+def main():
+    args = parse_args()
+    configs = [('none', None, False), ('zlib', 'zlib', False)]
+    if 'zstd' in compression_utils.get_available_encodings():
+        configs += [('zstd', 'zstd', False), ('zstd+dict', 'zstd', True)]
+    ents = generate_ents(num_ents=args.num_ents)
+    print('%-10s %12s %14s %12s' % ('config', 'file bytes', 'value bytes',
+                                    'read ms'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for config_name, encoding, use_dict in configs:
+            db_path = os.path.join(tmp_dir, '%s.db' % config_name)
+            dao = _dao.Dao(db_uri='sqlite:///%s' % db_path,
+                           value_compression=encoding)
+            dao.ensure_tables()
+            if use_dict:
+                # Train on plain rows, then rewrite them with the dict.
+                dao.value_compression = None
+                dao.create_ents(ents=ents)
+                dao.value_compression = encoding
+                dao.train_value_compression_dict()
+                dao.upsert_ents(ents=[
+                    {'key': ent['key'], 'patches': ent['props']}
+                    for ent in ents
+                ])
+            else: dao.create_ents(ents=ents)
+            dao.execute_sql(sql='VACUUM', rw_mode='w')
+            read_time = time_reads(dao=dao, repeats=args.repeats)
+            print('%-10s %12s %14s %12.1f' % (
+                config_name, os.path.getsize(db_path),
+                get_value_bytes(dao=dao), read_time * 1000))
+            dao.engine.dispose()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-ents', type=int, default=5000)
+    parser.add_argument('--repeats', type=int, default=3)
+    return parser.parse_args()
+
+def generate_ents(num_ents=None):
+    return [
+        {'key': 'ent_%s' % i,
+         'props': {
+             'idx': i,
+             'items': [{'sku': 'sku_%s' % ((i + j) % 97), 'qty': j,
+                        'status': ['open', 'shipped', 'returned'][j % 3]}
+                       for j in range(i % 20 + 5)],
+         }}
+        for i in range(num_ents)
+    ]
+
+def get_value_bytes(dao=None):
+    return dao.execute_sql(
+        sql='SELECT SUM(LENGTH(value)) AS value_bytes FROM props'
+    )[0]['value_bytes']
+
+def time_reads(dao=None, repeats=None):
+    start = time.perf_counter()
+    for _ in range(repeats): dao.query_ents()
+    return (time.perf_counter() - start) / repeats
+
+if __name__ == '__main__': main()
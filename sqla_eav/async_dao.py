@@ -0,0 +1,87 @@
+import asyncio
+import concurrent.futures
+import functools
+
+import sqlalchemy.pool as _sqla_pool
+
+from . import dao as _dao
+
+
+def _run_in_executor(method_name=None):
+    async def method(self, **kwargs):
+        return await self.run(getattr(self.dao, method_name), **kwargs)
+    method.__name__ = method_name
+    return method
+
+class AsyncDao(object):
+    # SQLAlchemy 1.3 has no asyncio engine, so calls run on a thread pool
+    # with one pooled connection per worker thread.
+    DEFAULT_MAX_WORKERS = 10
+    GATHER_ENTS_CHUNK_SIZE = 500
+
+    def __init__(self, dao=None, executor=None, max_workers=None,
+                 **dao_kwargs):
+        max_workers = max_workers or self.DEFAULT_MAX_WORKERS
+        if dao is None and _dao.is_in_memory_sqlite_url(
+            url=dao_kwargs.get('db_uri')):
+            # An in-memory db lives in one connection, so every worker
+            # shares it, one call at a time.
+            dao_kwargs['engine_kwargs'] = {
+                'poolclass': _sqla_pool.StaticPool,
+                'connect_args': {'check_same_thread': False},
+                **(dao_kwargs.get('engine_kwargs') or {}),
+            }
+            max_workers = 1
+        self.dao = dao or _dao.Dao(**dao_kwargs)
+        if _dao.is_in_memory_sqlite_url(url=self.dao.engine.url) and \
+           not isinstance(self.dao.engine.pool, _sqla_pool.StaticPool):
+            raise ValueError("in-memory sqlite daos need a StaticPool engine,"
+                             " or each worker opens its own empty database")
+        self._owns_executor = executor is None
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    ensure_tables = _run_in_executor('ensure_tables')
+    create_tables = _run_in_executor('create_tables')
+    create_ent = _run_in_executor('create_ent')
+    create_ents = _run_in_executor('create_ents')
+    get_ent = _run_in_executor('get_ent')
+    get_ents = _run_in_executor('get_ents')
+    update_ent = _run_in_executor('update_ent')
+    upsert_ent = _run_in_executor('upsert_ent')
+    upsert_ents = _run_in_executor('upsert_ents')
+    query_ents = _run_in_executor('query_ents')
+    query_ents_page = _run_in_executor('query_ents_page')
+    count_ents = _run_in_executor('count_ents')
+    aggregate = _run_in_executor('aggregate')
+    delete_ent = _run_in_executor('delete_ent')
+    delete_ents = _run_in_executor('delete_ents')
+    changes_since = _run_in_executor('changes_since')
+    execute_sql = _run_in_executor('execute_sql')
+
+    async def gather_ents(self, keys=None, props=None, chunk_size=None):
+        keys = list(keys)
+        chunks = _dao.iter_batches(
+            items=keys, batch_size=(chunk_size or self.GATHER_ENTS_CHUNK_SIZE))
+        ents = {}
+        for chunk_ents in await asyncio.gather(*[
+            self.get_ents(keys=chunk, props=props) for chunk in chunks
+        ]):
+            ents.update(chunk_ents)
+        return {key: ents[key] for key in keys if key in ents}
+
+    async def gather_query_ents(self, queries=None):
+        return await asyncio.gather(*[self.query_ents(query=query)
+                                      for query in queries])
+
+    def close(self):
+        if self._owns_executor: self.executor.shutdown(wait=True)
+
+    async def __aenter__(self): return self
+
+    async def __aexit__(self, *exc_info): self.close()
@@ -0,0 +1,42 @@
+import copy
+import threading
+
+
+class LazyBlobValue(object):
+    # Stands in for a prop value offloaded to the blobs table; the blob is
+    # fetched on first access, or in bulk via Dao.load_lazy_values.
+    def __init__(self, dao=None, blob_key=None, type_=None):
+        self.dao = dao
+        self.blob_key = blob_key
+        self.type_ = type_
+        self._value = None
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        with self._lock:
+            if not self.loaded:
+                raw_values = self.dao.load_blob_raw_values(
+                    blob_keys=[self.blob_key])
+                self.set_raw_value(raw_value=raw_values[self.blob_key])
+            return self._value
+
+    def set_raw_value(self, raw_value=None):
+        self._value = self.dao.deserialize_value(raw_value=raw_value,
+                                                 type_=self.type_)
+        self.loaded = True
+
+    def __deepcopy__(self, memo):
+        # Shares the dao rather than copying its engine.
+        lazy_value = LazyBlobValue(dao=self.dao, blob_key=self.blob_key,
+                                   type_=self.type_)
+        if self.loaded:
+            lazy_value._value = copy.deepcopy(self._value, memo)
+            lazy_value.loaded = True
+        return lazy_value
+
+    def __repr__(self):
+        return '<LazyBlobValue {blob_key} ({state})>'.format(
+            blob_key=self.blob_key,
+            state=('loaded' if self.loaded else 'not loaded'))
@@ -0,0 +1,117 @@
+import base64
+import json
+import math
+
+try: import orjson as _orjson
+except ImportError: _orjson = None
+
+try: import msgpack as _msgpack
+except ImportError: _msgpack = None
+
+
+class JsonCodec(object):
+    name = 'json'
+    # Codecs that write plain JSON keep the bare type tag, so rows written
+    # before codecs existed and rows written by any JSON codec read the same.
+    json_compatible = True
+
+    def dumps(self, value): return json.dumps(value)
+
+    def loads(self, raw_value): return json.loads(raw_value)
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def dumps(self, value):
+        # orjson rejects values json accepts (e.g. ints past 64 bits, non-str
+        # keys) and writes NaN as null, so those fall back to json.
+        try: raw_value = _orjson.dumps(value)
+        except TypeError: return json.dumps(value)
+        if b'null' in raw_value: return json.dumps(value)
+        return raw_value.decode()
+
+    def loads(self, raw_value):
+        # Also covers rows json wrote with NaN/Infinity or huge ints.
+        try: return _orjson.loads(raw_value)
+        except ValueError: return json.loads(raw_value)
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    json_compatible = False
+
+    def dumps(self, value):
+        return base64.b64encode(_msgpack.packb(value, use_bin_type=True)
+                                ).decode()
+
+    def loads(self, raw_value):
+        return _msgpack.unpackb(base64.b64decode(raw_value), raw=False,
+                                strict_map_key=False)
+
+def _encode_float(value):
+    if math.isfinite(value): return float.__repr__(value)
+    return json.dumps(value)
+
+class CodecRegistry(object):
+    # Scalars are written as the exact text json.dumps would produce, so
+    # fast-path rows and JSON rows are interchangeable on read.
+    SCALAR_ENCODERS = {
+        'int': int.__repr__,
+        'float': _encode_float,
+        'bool': lambda value: 'true' if value else 'false',
+        'NoneType': lambda value: 'null',
+    }
+    SCALAR_DECODERS = {
+        'int': int,
+        'float': float,
+        'bool': lambda raw_value: raw_value == 'true',
+        'NoneType': lambda raw_value: None,
+    }
+    COMPACT_TYPE_TAGS = {'str': 's', 'int': 'i', 'float': 'f', 'bool': 'b',
+                         'NoneType': 'n', 'dict': 'd', 'list': 'l'}
+    TYPE_NAMES = {tag: type_name
+                  for type_name, tag in COMPACT_TYPE_TAGS.items()}
+
+    def __init__(self, default_codec='json', compact_type_tags=False):
+        self.codecs = {}
+        self.register_codec(JsonCodec())
+        if _orjson is not None: self.register_codec(OrjsonCodec())
+        if _msgpack is not None: self.register_codec(MsgpackCodec())
+        if default_codec not in self.codecs:
+            raise Exception("codec '{codec}' is not available".format(
+                codec=default_codec))
+        self.default_codec = self.codecs[default_codec]
+        self.compact_type_tags = compact_type_tags
+
+    def register_codec(self, codec=None): self.codecs[codec.name] = codec
+
+    def encode(self, value=None):
+        type_name = type(value).__name__
+        if type_name == 'str': raw_value, codec = value, None
+        elif type_name in self.SCALAR_ENCODERS:
+            raw_value, codec = self.SCALAR_ENCODERS[type_name](value), None
+        else:
+            codec = self.default_codec
+            raw_value = codec.dumps(value)
+        type_tag = type_name
+        if self.compact_type_tags:
+            type_tag = self.COMPACT_TYPE_TAGS.get(type_name, type_name)
+        if codec is not None and not codec.json_compatible:
+            type_tag = '%s:%s' % (type_tag, codec.name)
+        return type_tag, raw_value
+
+    def decode(self, raw_value=None, type_tag=None):
+        if not type_tag: return raw_value
+        type_name, _, codec_name = type_tag.partition(':')
+        type_name = self.TYPE_NAMES.get(type_name, type_name)
+        if type_name == 'str': return raw_value
+        decoder = self.SCALAR_DECODERS.get(type_name)
+        if decoder is not None and not codec_name: return decoder(raw_value)
+        codec = self.codecs[codec_name] if codec_name else self.default_codec
+        if not codec.json_compatible and not codec_name:
+            codec = self.codecs['json']
+        return codec.loads(raw_value)
+
+    def get_type_name(self, type_tag=None):
+        if not type_tag: return type_tag
+        type_name = type_tag.partition(':')[0]
+        return self.TYPE_NAMES.get(type_name, type_name)
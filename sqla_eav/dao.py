@@ -1,91 +1,755 @@
+import array
+import collections
+import base64
+import contextlib
+import hashlib
+import itertools
 import json
 import logging
+import math
 import re
+import sys
+import threading
 
 import sqlalchemy as _sqla
+import sqlalchemy.dialects.mysql as _sqla_mysql
+import sqlalchemy.dialects.postgresql as _sqla_postgresql
 import sqlalchemy.exc as _sqla_exc
 
+try: import numpy as _np
+except ImportError: _np = None
+
+from . import blobs
+from . import codecs
+from . import planner
 from . import schema
+from .utils import compression_utils
+from .utils.cache_utils import LRUCache
 
 class Dao(object):
     exc = _sqla_exc
-    BINARY_OPS = ['=', '<', '>', '<=', '>=', 'LIKE']
+    BINARY_OPS = ['=', '<', '>', '<=', '>=', 'LIKE', 'IN']
     EXISTENCE_OP = 'EXISTS'
+    OP_PATTERN = re.compile(r'^\s*(?:(!)\s*|(NOT)\s+)?(.*?)\s*$', re.IGNORECASE)
+    FILTER_TREE_OPS = ['and', 'or', 'not']
+    CREATE_ENTS_BATCH_SIZE = 250
+    TYPED_VALUE_COLUMNS = ['value_int', 'value_float', 'value_bool']
+    FILTER_VALUE_COLUMNS = {'int': 'value_int', 'float': 'value_float',
+                            'bool': 'value_bool'}
+    MAX_VALUE_INT = 2 ** 63 - 1
+    INDEX_PREFIX_LENGTH = 255
+    PARTIAL_INDEX_DIALECTS = ['postgresql', 'sqlite']
+    PAGE_QUERY_KEYS = ['limit', 'order_by', 'cursor']
+    ITER_ENTS_FETCH_SIZE = 1000
+    UPSERT_ENTS_BATCH_SIZE = 250
+    STATEMENT_CACHE_SIZE = 256
+    PROP_FILTER_STRATEGIES = ['join', 'exists', 'in_subquery']
+    DEFAULT_PROP_FILTER_STRATEGY = 'exists'
+    # SQLite runs EXISTS as a per-row probe over every candidate ent, while
+    # IN (SELECT ...) lets it build the matching key set once.
+    DIALECT_PROP_FILTER_STRATEGIES = {'sqlite': 'in_subquery'}
+    AGGREGATE_OPS = {'count': _sqla.func.count, 'sum': _sqla.func.sum,
+                     'avg': _sqla.func.avg, 'min': _sqla.func.min,
+                     'max': _sqla.func.max}
+    MAX_BIND_PARAMS = {'sqlite': 999, 'mssql': 2000, 'oracle': 1000}
+    DEFAULT_MAX_BIND_PARAMS = 30000
+    NATIVE_UPSERT_DIALECTS = ['mysql', 'postgresql', 'sqlite']
+    UPSERT_PROP_COLUMNS = ['value', 'type', *TYPED_VALUE_COLUMNS, 'blob_key',
+                           'value_size', 'value_encoding', 'modified']
+    DEFAULT_BLOB_ENCODING = 'zlib'
+    VALUE_COMPRESSION_THRESHOLD = 256
+    COMPRESSION_DICT_SAMPLE_SIZE = 1000
+    COMPRESSION_DICT_SIZE = 16 * 1024
+    CHANGES_BATCH_SIZE = 1000
+    NUMERIC_COLUMN_TYPECODES = {'int': 'q', 'float': 'd'}
+    # Indexes older schemas created, mapped to (table, column). Composite
+    # indexes leading with the same column cover these, which only added
+    # write cost.
+    OBSOLETE_INDEXES = {'ix_props_prop': ('props', 'prop'),
+                        'ix_props_ent_key': ('props', 'ent_key')}
 
     class StaleEntError(Exception): pass
 
-    def __init__(self, db_uri=None, schema=None, engine=None, logger=None):
+    def __init__(self, db_uri=None, schema=None, engine=None, logger=None,
+                 engine_kwargs=None, statement_cache_size=STATEMENT_CACHE_SIZE,
+                 prop_filter_strategy=None, codec_registry=None,
+                 blob_threshold=None, blob_encoding=DEFAULT_BLOB_ENCODING,
+                 value_compression=None,
+                 value_compression_threshold=VALUE_COMPRESSION_THRESHOLD,
+                 track_deletions=False):
         self.logger = logger or logging
-        self.engine = engine or _sqla.create_engine(db_uri)
+        self.engine_kwargs = engine_kwargs
+        self.engine = engine or _sqla.create_engine(db_uri,
+                                                    **(engine_kwargs or {}))
         self.schema = schema or self.get_default_schema()
+        self._local = threading.local()
+        self.write_listeners = []
+        self.planner = None
+        self.codec_registry = codec_registry or codecs.CodecRegistry()
+        # Values whose serialized text is longer than blob_threshold are
+        # stored in the blobs table; None keeps every value inline.
+        # Offloaded values no longer match '=' or LIKE filters on their text.
+        self.blob_threshold = blob_threshold
+        compression_utils.validate_encoding(encoding=blob_encoding)
+        self.blob_encoding = blob_encoding
+        # Inline values at least value_compression_threshold long are
+        # compressed when value_compression names an encoding. Compressed
+        # values no longer match '=' or LIKE filters on their text.
+        if value_compression is not None:
+            compression_utils.validate_encoding(encoding=value_compression)
+        self.value_compression = value_compression
+        self.value_compression_threshold = value_compression_threshold
+        self.value_compression_dict = None
+        self._compression_dicts = {}
+        # Deleted ents leave tombstones so change feeds can report them.
+        self.track_deletions = track_deletions
+        self.prop_filter_strategy = prop_filter_strategy or \
+                self.DIALECT_PROP_FILTER_STRATEGIES.get(
+                    self.engine.dialect.name, self.DEFAULT_PROP_FILTER_STRATEGY)
+        self.statement_cache_size = statement_cache_size
+        if statement_cache_size:
+            self.statement_cache = LRUCache(max_size=statement_cache_size)
+            self.compiled_cache = LRUCache(max_size=statement_cache_size)
+        else: self.statement_cache = self.compiled_cache = None
 
     def get_default_schema(self): return schema.generate_schema()
 
-    def ensure_tables(self): self.create_tables()
+    def get_clone_kwargs(self):
+        # Builds an equivalent Dao with its own engine, e.g. in a worker.
+        return {
+            'db_uri': self.engine.url, 'schema': self.schema,
+            'engine_kwargs': self.engine_kwargs,
+            'statement_cache_size': self.statement_cache_size,
+            'prop_filter_strategy': self.prop_filter_strategy,
+            'codec_registry': self.codec_registry,
+            'blob_threshold': self.blob_threshold,
+            'blob_encoding': self.blob_encoding,
+            'value_compression': self.value_compression,
+            'value_compression_threshold': self.value_compression_threshold,
+            'track_deletions': self.track_deletions,
+        }
+
+    def ensure_tables(self):
+        self.create_tables()
+        self.ensure_columns()
+        self.ensure_indexes()
 
     def create_tables(self): self.schema['metadata'].create_all(self.engine)
 
     def drop_tables(self): self.schema['metadata'].drop_all(self.engine)
 
+    def ensure_columns(self):
+        # Tables created by older schemas lack later columns, so add them,
+        # then backfill typed values for rows written before they existed.
+        inspector = _sqla.inspect(self.engine)
+        preparer = self.engine.dialect.identifier_preparer
+        added_column_names = collections.defaultdict(list)
+        for table in self.schema['tables'].values():
+            existing_column_names = {
+                column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_column_names: continue
+                self.execute_sql(
+                    sql='ALTER TABLE {table} ADD COLUMN {column} {type_}'.format(
+                        table=preparer.format_table(table),
+                        column=preparer.format_column(column),
+                        type_=column.type.compile(dialect=self.engine.dialect)),
+                    rw_mode='w')
+                added_column_names[table.name].append(column.name)
+        props_table = self.schema['tables']['props']
+        if set(self.TYPED_VALUE_COLUMNS) & \
+           set(added_column_names.get(props_table.name, [])):
+            self.backfill_typed_values()
+        return dict(added_column_names)
+
+    def backfill_typed_values(self, batch_size=None):
+        props_table = self.schema['tables']['props']
+        batch_size = batch_size or self.UPSERT_ENTS_BATCH_SIZE
+        rows = self.execute(
+            _sqla.select([props_table.c.key, props_table.c.value,
+                          props_table.c.type])
+            .where(props_table.c.value.isnot(None))
+            .where(_sqla.and_(*[props_table.c[column_name].is_(None)
+                                for column_name in self.TYPED_VALUE_COLUMNS]))
+        ).fetchall()
+        updates = []
+        for row in rows:
+            type_name = self.codec_registry.get_type_name(type_tag=row['type'])
+            if type_name not in self.FILTER_VALUE_COLUMNS: continue
+            updates.append({
+                'prop_key': row['key'],
+                **self.get_typed_values(value=self.deserialize_value(
+                    raw_value=row['value'], type_=row['type']))
+            })
+        for batch in iter_batches(items=updates, batch_size=batch_size):
+            with self.engine.begin() as connection:
+                self.execute(
+                    props_table.update()
+                    .where(props_table.c.key == _sqla.bindparam('prop_key'))
+                    .values({column_name: _sqla.bindparam(column_name)
+                             for column_name in self.TYPED_VALUE_COLUMNS}),
+                    batch, connection=connection)
+        return len(updates)
+
+    def ensure_indexes(self):
+        existing_index_names = set(self.get_index_names())
+        tables = self.get_index_tables()
+        for table in tables.values():
+            for index in table.indexes:
+                if index.name in existing_index_names: continue
+                index.create(self.engine)
+        for index_name, (table_name, column_name) in \
+                self.OBSOLETE_INDEXES.items():
+            if index_name not in existing_index_names: continue
+            _sqla.Index(index_name, tables[table_name].c[column_name])\
+                    .drop(self.engine)
+
+    def get_index_names(self, table_name=None):
+        inspector = _sqla.inspect(self.engine)
+        table_names = [table_name] if table_name else self.schema['tables']
+        return [index['name'] for table_name in table_names
+                for index in inspector.get_indexes(table_name)]
+
+    def get_index_tables(self):
+        # Indexes whose definition depends on the dialect are attached to
+        # copies of the schema tables, so they never leak into create_all.
+        metadata = _sqla.MetaData()
+        tables = {key: table.tometadata(metadata)
+                  for key, table in self.schema['tables'].items()}
+        props = tables['props']
+        dialect_name = self.engine.dialect.name
+        if dialect_name == 'postgresql':
+            # btree rows are size-limited, hash indexes are not.
+            _sqla.Index('ix_props_value', props.c.value,
+                        postgresql_using='hash')
+        else:
+            _sqla.Index('ix_props_prop_value', props.c.prop, props.c.value,
+                        mysql_length={'prop': self.INDEX_PREFIX_LENGTH,
+                                      'value': self.INDEX_PREFIX_LENGTH})
+        return tables
+
+    def create_prop_index(self, prop=None, value_column='value'):
+        dialect_name = self.engine.dialect.name
+        if dialect_name not in self.PARTIAL_INDEX_DIALECTS:
+            self.logger.warning(
+                "partial indexes are not supported for dialect '%s', skipping"
+                " index for prop '%s'", dialect_name, prop)
+            return None
+        index_name = self.get_prop_index_name(prop=prop,
+                                              value_column=value_column)
+        if index_name in self.get_index_names(table_name='props'):
+            return index_name
+        props = self.get_index_tables()['props']
+        index_kwargs = {'%s_where' % dialect_name: (props.c.prop == prop)}
+        if value_column == 'value' and dialect_name == 'postgresql':
+            index_columns = [props.c.value]
+            index_kwargs['postgresql_using'] = 'hash'
+        else: index_columns = [props.c[value_column], props.c.ent_key]
+        _sqla.Index(index_name, *index_columns,
+                    **index_kwargs).create(self.engine)
+        return index_name
+
+    def drop_prop_index(self, prop=None, value_column='value'):
+        index_name = self.get_prop_index_name(prop=prop,
+                                              value_column=value_column)
+        if index_name not in self.get_index_names(table_name='props'): return
+        props = self.get_index_tables()['props']
+        _sqla.Index(index_name, props.c[value_column]).drop(self.engine)
+
+    def get_prop_index_name(self, prop=None, value_column='value'):
+        prop_hash = hashlib.md5(prop.encode()).hexdigest()[:12]
+        return 'ix_props_{value_column}_{prop_hash}'.format(
+            value_column=value_column, prop_hash=prop_hash)
+
     def create_ent(self, ent_key=None, props=None, connection=None):
         if ent_key is None: ent_key = self.generate_key()
         self.execute(self.schema['tables']['ents'].insert(), [{'key': ent_key}],
                      connection=connection)
         if props: self.create_props(ent_key=ent_key, props=props,
                                     connection=connection)
-        return self.query_ents(query={
-            'ent_filters': [{'col': 'key', 'op': '=', 'arg': ent_key}]
-        }, connection=connection)[ent_key]
+        return self.get_ent(key=ent_key, connection=connection)
+
+    def create_ents(self, ents=None, return_ents=False, batch_size=None,
+                    connection=None):
+        batch_size = batch_size or self.CREATE_ENTS_BATCH_SIZE
+        with self._connection_scope(connection=connection) as connection:
+            ent_keys = []
+            for batch in iter_batches(items=ents, batch_size=batch_size):
+                with connection.begin():
+                    ent_keys.extend(self._create_ents_batch(
+                        ents=batch, connection=connection))
+            if not return_ents: return ent_keys
+            created_ents = {}
+            for batch in iter_batches(items=ent_keys, batch_size=batch_size):
+                created_ents.update(self.get_ents(keys=batch,
+                                                  connection=connection))
+            return created_ents
+
+    def _create_ents_batch(self, ents=None, connection=None):
+        ent_keys = []
+        prop_values = []
+        for ent in ents:
+            ent_key = ent.get('key')
+            if ent_key is None: ent_key = self.generate_key()
+            ent_keys.append(ent_key)
+            prop_values.extend(
+                self.get_prop_values(ent_key=ent_key,
+                                     props=(ent.get('props') or {}))
+            )
+        self.execute(self.schema['tables']['ents'].insert().values(
+            [{'key': ent_key} for ent_key in ent_keys]), connection=connection)
+        if prop_values:
+            self.save_blobs(prop_values=prop_values, connection=connection)
+            self.execute(self.schema['tables']['props'].insert(), prop_values,
+                         connection=connection)
+        return ent_keys
+
+    def get_ent(self, key=None, props=None, connection=None):
+        return self.get_ents(keys=[key], props=props,
+                             connection=connection).get(key)
+
+    def get_ents(self, keys=None, props=None, connection=None):
+        ent_dicts = {}
+        chunk_size = max(self.get_max_bind_params() - len(props or []), 1)
+        statements = self._get_ents_by_keys_statements(props=props)
+        unique_keys = list(collections.OrderedDict.fromkeys(keys))
+        with self._connection_scope(connection=connection) as connection:
+            for chunk in iter_batches(items=unique_keys, batch_size=chunk_size):
+                params = {'ent_keys': chunk}
+                if props: params['props'] = list(props)
+                for row in self.execute_prepared_query(
+                    prepared_query={'statement': statements['ents'],
+                                    'params': params},
+                    connection=connection
+                ).fetchall():
+                    ent_dicts[row['key']] = {'key': row['key'],
+                                             'modified': row['modified'],
+                                             'props': {}}
+                for row in self.execute_prepared_query(
+                    prepared_query={'statement': statements['props'],
+                                    'params': params},
+                    connection=connection
+                ).fetchall():
+                    ent_dict = ent_dicts.get(row['ent_key'])
+                    if ent_dict is None: continue
+                    ent_dict['props'][row['prop']] = self.deserialize_value(
+                        raw_value=row['value'], type_=row['type'],
+                        blob_key=row['blob_key'],
+                        value_encoding=row['value_encoding'])
+        return {key: ent_dicts[key] for key in unique_keys if key in ent_dicts}
+
+    def _get_ents_by_keys_statements(self, props=None):
+        statements_key = ('get_ents', bool(props))
+        statements = None
+        if self.statement_cache is not None:
+            statements = self.statement_cache.get(statements_key)
+        if statements is not None: return statements
+        ents = self.schema['tables']['ents']
+        props_table = self.schema['tables']['props']
+        ent_keys_param = _sqla.bindparam('ent_keys', expanding=True)
+        statements = {
+            'ents': _sqla.select([ents.c.key, ents.c.modified])
+            .where(ents.c.key.in_(ent_keys_param)),
+            'props': _sqla.select([props_table.c.ent_key, props_table.c.prop,
+                                   props_table.c.value, props_table.c.type,
+                                   props_table.c.blob_key,
+                                   props_table.c.value_encoding])
+            .where(props_table.c.ent_key.in_(ent_keys_param)),
+        }
+        if props:
+            statements['props'] = statements['props'].where(
+                props_table.c.prop.in_(
+                    _sqla.bindparam('props', expanding=True)))
+        if self.statement_cache is not None:
+            self.statement_cache[statements_key] = statements
+        return statements
+
+    def get_max_bind_params(self):
+        return self.MAX_BIND_PARAMS.get(self.engine.dialect.name,
+                                        self.DEFAULT_MAX_BIND_PARAMS)
 
     def generate_key(self): return schema.generate_key()
 
+    def add_write_listener(self, listener=None):
+        self.write_listeners.append(listener)
+
+    def notify_ents_written(self, ent_keys=None):
+        for listener in self.write_listeners: listener(ent_keys=ent_keys)
+
+    def get_ents_modified(self, ent_keys=None, connection=None):
+        ents = self.schema['tables']['ents']
+        statement = _sqla.select([ents.c.key, ents.c.modified])\
+                .where(ents.c.key.in_(ent_keys))
+        return {row['key']: row['modified'] for row in
+                self.execute(statement, connection=connection).fetchall()}
+
     def execute(self, *args, connection=None, **kwargs):
-        connection = connection or self.connection
+        connection = connection or self.current_connection
+        # Connectionless execution releases the pooled connection once the
+        # result is exhausted or closed.
+        if connection is None: return self.engine.execute(*args, **kwargs)
         return connection.execute(*args, **kwargs)
 
     @property
-    def connection(self): return self.engine.connect()
+    def connection(self):
+        # Fresh connections are owned by the caller, who must close them.
+        return self.current_connection or self.engine.connect()
+
+    @property
+    def current_connection(self):
+        return getattr(self._local, 'connection', None)
+
+    @contextlib.contextmanager
+    def session(self, transactional=False):
+        connection = self.current_connection
+        if connection is not None:
+            with contextlib.ExitStack() as stack:
+                if transactional: stack.enter_context(connection.begin())
+                yield connection
+            return
+        connection = self.engine.connect()
+        self._local.connection = connection
+        try:
+            with contextlib.ExitStack() as stack:
+                if transactional: stack.enter_context(connection.begin())
+                yield connection
+        finally:
+            self._local.connection = None
+            connection.close()
+
+    @contextlib.contextmanager
+    def _connection_scope(self, connection=None):
+        if connection is not None:
+            yield connection
+            return
+        with self.session() as connection: yield connection
 
     def create_props(self, ent_key=None, props=None, connection=None):
         statement = self.schema['tables']['props'].insert()
-        values = [
+        values = self.get_prop_values(ent_key=ent_key, props=props)
+        self.save_blobs(prop_values=values, connection=connection)
+        return self.execute(statement, values, connection=connection)
+
+    def get_prop_values(self, ent_key=None, props=None):
+        return [
             {'ent_key': ent_key, 'prop': prop, **self.serialize_value(value)}
             for prop, value in props.items()
         ]
-        return self.execute(statement, values, connection=connection)
 
     def serialize_value(self, value=None):
+        type_, raw_value = self.codec_registry.encode(value=value)
+        typed_values = self.get_typed_values(value=value)
+        serialized_value = {'type': type_, 'value': raw_value, **typed_values,
+                            'blob_key': None, 'value_size': len(raw_value),
+                            'value_encoding': None}
+        if self.blob_threshold is not None and \
+           len(raw_value) > self.blob_threshold:
+            # Blobs are keyed by content, so identical values share a blob.
+            # The raw text rides along under 'blob' until save_blobs.
+            serialized_value.update({
+                'value': None,
+                'blob_key': hashlib.sha256(raw_value.encode()).hexdigest(),
+                'blob': raw_value,
+            })
+        elif self.value_compression is not None and \
+                len(raw_value) >= self.value_compression_threshold:
+            serialized_value.update(self.compress_raw_value(
+                raw_value=raw_value))
+        return serialized_value
+
+    def compress_raw_value(self, raw_value=None):
+        value_encoding = self.value_compression
+        dictionary = None
+        if value_encoding == 'zstd' and self.value_compression_dict:
+            dictionary = self.value_compression_dict['data']
+            value_encoding = 'zstd:%s' % self.value_compression_dict['key']
+        compressed_value = base64.b64encode(compression_utils.compress(
+            data=raw_value.encode(), encoding=self.value_compression,
+            dictionary=dictionary)).decode()
+        # Incompressible values stay plain rather than grow.
+        if len(compressed_value) >= len(raw_value): return {}
+        return {'value': compressed_value, 'value_encoding': value_encoding}
+
+    def decompress_raw_value(self, raw_value=None, value_encoding=None):
+        encoding, _, dict_key = value_encoding.partition(':')
+        dictionary = None
+        if dict_key: dictionary = self.get_compression_dict(key=dict_key)
+        return compression_utils.decompress(
+            data=base64.b64decode(raw_value), encoding=encoding,
+            dictionary=dictionary).decode()
+
+    def get_compression_dict(self, key=None, connection=None):
+        if key not in self._compression_dicts:
+            dicts_table = self.schema['tables']['compression_dicts']
+            row = self.execute(
+                _sqla.select([dicts_table.c.data])
+                .where(dicts_table.c.key == key),
+                connection=connection
+            ).first()
+            if row is None:
+                raise Exception("unknown compression dict '{key}'".format(
+                    key=key))
+            self._compression_dicts[key] = row['data']
+        return self._compression_dicts[key]
+
+    def train_value_compression_dict(self, sample_size=None, dict_size=None,
+                                     connection=None):
+        props_table = self.schema['tables']['props']
+        samples = [
+            row['value'].encode() for row in self.execute(
+                _sqla.select([props_table.c.value])
+                .where(props_table.c.value_encoding.is_(None))
+                .where(props_table.c.value.isnot(None))
+                .where(props_table.c.value_size >=
+                       self.value_compression_threshold)
+                .limit(sample_size or self.COMPRESSION_DICT_SAMPLE_SIZE),
+                connection=connection
+            ).fetchall()
+        ]
+        dictionary = compression_utils.train_dictionary(
+            samples=samples,
+            dict_size=(dict_size or self.COMPRESSION_DICT_SIZE))
+        dict_key = self.generate_key()
+        self.execute(self.schema['tables']['compression_dicts'].insert(),
+                     [{'key': dict_key, 'encoding': 'zstd',
+                       'data': dictionary}],
+                     connection=connection)
+        self._compression_dicts[dict_key] = dictionary
+        self.value_compression_dict = {'key': dict_key, 'data': dictionary}
+        return dict_key
+
+    def load_value_compression_dict(self, connection=None):
+        dicts_table = self.schema['tables']['compression_dicts']
+        row = self.execute(
+            _sqla.select([dicts_table.c.key, dicts_table.c.data])
+            .order_by(dicts_table.c.created.desc()).limit(1),
+            connection=connection
+        ).first()
+        if row is None: return None
+        self._compression_dicts[row['key']] = row['data']
+        self.value_compression_dict = {'key': row['key'], 'data': row['data']}
+        return row['key']
+
+    def save_blobs(self, prop_values=None, connection=None):
+        blob_values = {}
+        for prop_value in prop_values:
+            raw_value = prop_value.pop('blob', None)
+            if raw_value is not None:
+                blob_values[prop_value['blob_key']] = raw_value
+        if not blob_values: return
+        blobs_table = self.schema['tables']['blobs']
+        existing_blob_keys = {
+            row['key'] for row in self.execute(
+                _sqla.select([blobs_table.c.key])
+                .where(blobs_table.c.key.in_(list(blob_values))),
+                connection=connection
+            ).fetchall()
+        }
+        new_blobs = []
+        for blob_key, raw_value in blob_values.items():
+            if blob_key in existing_blob_keys: continue
+            data = raw_value.encode()
+            new_blobs.append({
+                'key': blob_key, 'encoding': self.blob_encoding,
+                'size': len(data),
+                'data': compression_utils.compress(
+                    data=data, encoding=self.blob_encoding),
+            })
+        if new_blobs:
+            self.execute(blobs_table.insert(), new_blobs, connection=connection)
+
+    def load_blob_raw_values(self, blob_keys=None, connection=None):
+        blobs_table = self.schema['tables']['blobs']
+        raw_values = {}
+        for chunk in iter_batches(items=set(blob_keys),
+                                  batch_size=self.get_max_bind_params()):
+            for row in self.execute(
+                _sqla.select([blobs_table.c.key, blobs_table.c.encoding,
+                              blobs_table.c.data])
+                .where(blobs_table.c.key.in_(chunk)),
+                connection=connection
+            ).fetchall():
+                raw_values[row['key']] = compression_utils.decompress(
+                    data=row['data'], encoding=row['encoding']).decode()
+        return raw_values
+
+    def load_lazy_values(self, ents=None, connection=None):
+        lazy_values = [
+            value for ent in ents.values() for value in ent['props'].values()
+            if isinstance(value, blobs.LazyBlobValue) and not value.loaded
+        ]
+        if lazy_values:
+            raw_values = self.load_blob_raw_values(
+                blob_keys=[value.blob_key for value in lazy_values],
+                connection=connection)
+            for value in lazy_values:
+                value.set_raw_value(raw_value=raw_values[value.blob_key])
+        for ent in ents.values():
+            for prop, value in ent['props'].items():
+                if isinstance(value, blobs.LazyBlobValue):
+                    ent['props'][prop] = value.value
+        return ents
+
+    def delete_orphaned_blobs(self, connection=None):
+        blobs_table = self.schema['tables']['blobs']
+        props_table = self.schema['tables']['props']
+        return self.execute(
+            blobs_table.delete().where(~blobs_table.c.key.in_(
+                _sqla.select([props_table.c.blob_key])
+                .where(props_table.c.blob_key.isnot(None)))),
+            connection=connection
+        ).rowcount
+
+    def get_typed_values(self, value=None):
+        typed_values = dict.fromkeys(self.TYPED_VALUE_COLUMNS)
         type_ = type(value).__name__
-        if type_ != 'str': value = json.dumps(value)
-        return {'type': type_, 'value': value}
+        if type_ == 'bool': typed_values['value_bool'] = value
+        elif type_ == 'int':
+            if abs(value) <= self.MAX_VALUE_INT:
+                typed_values['value_int'] = value
+            if abs(value) <= sys.float_info.max:
+                typed_values['value_float'] = float(value)
+        elif type_ == 'float' and math.isfinite(value):
+            typed_values['value_float'] = value
+        return typed_values
 
-    def deserialize_value(self, raw_value=None, type_=None):
-        if type_ and type_ != 'str': return json.loads(raw_value)
-        return raw_value
+    def deserialize_value(self, raw_value=None, type_=None, blob_key=None,
+                          value_encoding=None):
+        if blob_key is not None and raw_value is None:
+            return blobs.LazyBlobValue(dao=self, blob_key=blob_key,
+                                       type_=type_)
+        if value_encoding is not None:
+            raw_value = self.decompress_raw_value(
+                raw_value=raw_value, value_encoding=value_encoding)
+        return self.codec_registry.decode(raw_value=raw_value, type_tag=type_)
 
     def update_ent(self, ent_key=None, patches=None, deletions=None,
-                    ent_modified=None, connection=None):
-        connection = connection or self.connection
-        trans = connection.begin()
-        try:
-            if ent_modified:
+                    ent_modified=None, diff=False, connection=None):
+        with self._connection_scope(connection=connection) as connection:
+            trans = connection.begin()
+            try:
+                if diff:
+                    self._update_ent_by_diff(
+                        ent_key=ent_key, patches=patches, deletions=deletions,
+                        ent_modified=ent_modified, connection=connection)
+                    trans.commit()
+                    return
+                if ent_modified:
+                    self.validate_and_update_ent_modified(
+                        ent_key=ent_key, modified=ent_modified,
+                        connection=connection)
+                deletions = deletions or []
+                props_to_delete = list(patches.keys()) + deletions
+                patches_to_insert = {
+                    prop: value for prop, value in patches.items()
+                    if prop not in deletions
+                }
+                self.delete_props(ent_key=ent_key,
+                                  props_to_delete=props_to_delete,
+                                  connection=connection)
+                if patches_to_insert:
+                    self.create_props(ent_key=ent_key, props=patches_to_insert,
+                                      connection=connection)
+                self.update_ent_modified(ent_key=ent_key,
+                                         connection=connection)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            finally: self.notify_ents_written(ent_keys=[ent_key])
+
+    def _update_ent_by_diff(self, ent_key=None, patches=None, deletions=None,
+                            ent_modified=None, connection=None):
+        prop_diff = self.get_prop_diff(ent_key=ent_key, patches=patches,
+                                       deletions=deletions,
+                                       connection=connection)
+        has_changes = any(prop_diff.values())
+        if ent_modified:
+            if has_changes:
                 self.validate_and_update_ent_modified(
                     ent_key=ent_key, modified=ent_modified,
                     connection=connection)
-            deletions = deletions or []
-            props_to_delete = list(patches.keys()) + deletions
-            patches_to_insert = {prop: value for prop, value in patches.items()
-                                 if prop not in deletions}
-            self.delete_props(ent_key=ent_key, props_to_delete=props_to_delete,
-                              connection=connection)
-            if patches_to_insert:
-                self.create_props(ent_key=ent_key, props=patches_to_insert,
-                                  connection=connection)
+            else:
+                self.validate_ent_modified(ent_key=ent_key,
+                                           modified=ent_modified,
+                                           connection=connection)
+        if not has_changes: return
+        self.apply_prop_diff(prop_diff=prop_diff, connection=connection)
+        if not ent_modified:
             self.update_ent_modified(ent_key=ent_key, connection=connection)
-            trans.commit()
-        except:
-            trans.rollback()
-            raise
+
+    def get_prop_diff(self, ent_key=None, patches=None, deletions=None,
+                      connection=None):
+        props_table = self.schema['tables']['props']
+        deletions = deletions or []
+        patches = {prop: value for prop, value in (patches or {}).items()
+                   if prop not in deletions}
+        statement = (
+            _sqla.select([props_table.c.key, props_table.c.prop,
+                          props_table.c.value, props_table.c.type,
+                          props_table.c.blob_key,
+                          props_table.c.value_encoding])
+            .where(props_table.c.ent_key == ent_key)
+            .where(props_table.c.prop.in_(list(patches.keys()) + deletions))
+        )
+        rows_by_prop = collections.defaultdict(list)
+        for row in self.execute(statement, connection=connection).fetchall():
+            rows_by_prop[row['prop']].append(row)
+        prop_diff = {'inserts': [], 'updates': [], 'deletions': []}
+        for prop in deletions:
+            prop_diff['deletions'].extend(row['key']
+                                          for row in rows_by_prop[prop])
+        for prop, value in patches.items():
+            serialized_value = self.serialize_value(value)
+            rows = rows_by_prop[prop]
+            if not rows:
+                prop_diff['inserts'].append(
+                    {'ent_key': ent_key, 'prop': prop, **serialized_value})
+                continue
+            # Collapse any duplicate rows for the prop onto the first one.
+            prop_diff['deletions'].extend(row['key'] for row in rows[1:])
+            if (
+                (rows[0]['value'], rows[0]['type'], rows[0]['blob_key'],
+                 rows[0]['value_encoding'])
+                != (serialized_value['value'], serialized_value['type'],
+                    serialized_value['blob_key'],
+                    serialized_value['value_encoding'])
+            ):
+                prop_diff['updates'].append(
+                    {'prop_key': rows[0]['key'], **serialized_value})
+        return prop_diff
+
+    def apply_prop_diff(self, prop_diff=None, connection=None):
+        props_table = self.schema['tables']['props']
+        self.save_blobs(prop_values=(prop_diff['updates'] +
+                                     prop_diff['inserts']),
+                        connection=connection)
+        if prop_diff['deletions']:
+            self.execute(
+                props_table.delete().where(
+                    props_table.c.key.in_(prop_diff['deletions'])),
+                connection=connection
+            )
+        if prop_diff['updates']:
+            self.execute(
+                props_table.update().where(
+                    props_table.c.key == _sqla.bindparam('prop_key')),
+                prop_diff['updates'], connection=connection
+            )
+        if prop_diff['inserts']:
+            self.execute(props_table.insert(), prop_diff['inserts'],
+                         connection=connection)
+
+    def validate_ent_modified(self, ent_key=None, modified=None,
+                              connection=None):
+        ents = self.schema['tables']['ents']
+        statement = (
+            _sqla.select([ents.c.key])
+            .where(ents.c.key == ent_key)
+            .where(ents.c.modified == modified)
+        )
+        if self.execute(statement, connection=connection).first() is None:
+            raise self.StaleEntError()
 
     def validate_and_update_ent_modified(self, ent_key=None, modified=None,
                                          connection=None):
@@ -112,21 +776,136 @@ class Dao(object):
         )
         self.execute(statement, connection=connection)
 
+    def delete_ent(self, ent_key=None, connection=None):
+        return self.delete_ents(ent_keys=[ent_key], connection=connection)
+
+    def delete_ents(self, ent_keys=None, connection=None):
+        ents = self.schema['tables']['ents']
+        props_table = self.schema['tables']['props']
+        ent_keys = list(ent_keys)
+        with self._connection_scope(connection=connection) as connection:
+            try:
+                deleted_ent_keys = []
+                for chunk in iter_batches(items=ent_keys,
+                                          batch_size=self.get_max_bind_params()):
+                    with connection.begin():
+                        existing_ent_keys = [
+                            row['key'] for row in self.execute(
+                                _sqla.select([ents.c.key])
+                                .where(ents.c.key.in_(chunk)),
+                                connection=connection
+                            ).fetchall()
+                        ]
+                        if not existing_ent_keys: continue
+                        self.execute(props_table.delete().where(
+                            props_table.c.ent_key.in_(existing_ent_keys)),
+                            connection=connection)
+                        self.execute(ents.delete().where(
+                            ents.c.key.in_(existing_ent_keys)),
+                            connection=connection)
+                        if self.track_deletions:
+                            self.execute(
+                                self.schema['tables']['tombstones'].insert(),
+                                [{'ent_key': ent_key}
+                                 for ent_key in existing_ent_keys],
+                                connection=connection)
+                    deleted_ent_keys.extend(existing_ent_keys)
+                return deleted_ent_keys
+            finally: self.notify_ents_written(ent_keys=ent_keys)
+
+    def changes_since(self, ts=None, limit=None, cursor=None, props=None,
+                      connection=None):
+        # Changes come in (modified, key) order. ts is inclusive, and cursor
+        # resumes strictly after the last change a previous call returned.
+        limit = limit or self.CHANGES_BATCH_SIZE
+        ents = self.schema['tables']['ents']
+        tombstones = self.schema['tables']['tombstones']
+        if isinstance(cursor, str): cursor = self.decode_cursor(cursor=cursor)
+        change_sources = [
+            (ents.c.key, ents.c.modified, _sqla.literal_column('0')),
+            (tombstones.c.ent_key, tombstones.c.deleted,
+             _sqla.literal_column('1')),
+        ]
+        change_selects = []
+        for i, (key_column, modified_column, deleted_column) in enumerate(
+            change_sources):
+            sort_specs = [{'column': column, 'desc': False}
+                          for column in [modified_column, key_column,
+                                         deleted_column]]
+            change_select = _sqla.select([
+                key_column.label('key'), modified_column.label('modified'),
+                deleted_column.label('deleted')
+            ])
+            if ts is not None:
+                change_select = change_select.where(modified_column >= ts)
+            if cursor is not None:
+                change_select = change_select.where(self.get_keyset_clause(
+                    sort_specs=sort_specs, cursor=cursor))
+            change_selects.append(_sqla.select([
+                change_select.order_by(modified_column, key_column)
+                .limit(limit).alias('changes_%s' % i)
+            ]))
+        changes = _sqla.union_all(*change_selects).alias('changes')
+        with self._connection_scope(connection=connection) as connection:
+            rows = self.execute(
+                _sqla.select([changes])
+                .order_by(changes.c.modified, changes.c.key, changes.c.deleted)
+                .limit(limit),
+                connection=connection
+            ).fetchall()
+            changed_ents = self.get_ents(
+                keys=[row['key'] for row in rows if not row['deleted']],
+                props=props, connection=connection)
+        # An ent deleted after the scan has ent None; its tombstone follows.
+        result_changes = [
+            {'key': row['key'], 'modified': row['modified'],
+             'deleted': bool(row['deleted']),
+             'ent': (None if row['deleted'] else changed_ents.get(row['key']))}
+            for row in rows
+        ]
+        if rows:
+            cursor = [rows[-1]['modified'], rows[-1]['key'],
+                      rows[-1]['deleted']]
+        return {
+            'changes': result_changes,
+            'cursor': (self.encode_cursor(sort_values=cursor)
+                       if cursor is not None else None),
+            'has_more': len(rows) == limit,
+        }
+
+    def iter_changes_since(self, ts=None, cursor=None, batch_size=None,
+                           props=None, connection=None):
+        while True:
+            changes_page = self.changes_since(
+                ts=ts, limit=batch_size, cursor=cursor, props=props,
+                connection=connection)
+            yield from changes_page['changes']
+            if not changes_page['has_more']: return
+            cursor = changes_page['cursor']
+
+    def prune_tombstones(self, before=None, connection=None):
+        tombstones = self.schema['tables']['tombstones']
+        return self.execute(
+            tombstones.delete().where(tombstones.c.deleted < before),
+            connection=connection
+        ).rowcount
+
     def execute_sql(self, sql=None, params=None, rw_mode=None, connection=None):
-        connection = connection or self.connection
-        trans = connection.begin()
-        try:
-            statement = _sqla.text(sql).bindparams(**(params or {}))
-            result_proxy = self.execute(statement, connection=connection)
-            if rw_mode == 'w': trans.commit()
-            else: trans.rollback()
-            if result_proxy.returns_rows:
-                results = self.result_proxy_to_dicts(result_proxy=result_proxy)
-            else: results = None
-            return results
-        except:
-            trans.rollback()
-            raise
+        with self._connection_scope(connection=connection) as connection:
+            trans = connection.begin()
+            try:
+                statement = _sqla.text(sql).bindparams(**(params or {}))
+                result_proxy = self.execute(statement, connection=connection)
+                if rw_mode == 'w': trans.commit()
+                else: trans.rollback()
+                if result_proxy.returns_rows:
+                    results = self.result_proxy_to_dicts(
+                        result_proxy=result_proxy)
+                else: results = None
+                return results
+            except:
+                trans.rollback()
+                raise
 
     def result_proxy_to_dicts(self, result_proxy=None):
         return [dict(row) for row in result_proxy.fetchall()]
@@ -141,18 +920,382 @@ class Dao(object):
                     'modified': ent_prop_dict['ent_modified'],
                     'props': {},
                 }
+            # Outer joins pad ents that have no props with a null prop row.
+            if ent_prop_dict['prop'] is None: continue
             try: type_ = ent_prop_dict['type']
             except: type_ = None
+            try: blob_key = ent_prop_dict['blob_key']
+            except: blob_key = None
+            try: value_encoding = ent_prop_dict['value_encoding']
+            except: value_encoding = None
             ent_dicts[ent_key]['props'][ent_prop_dict['prop']] = \
                     self.deserialize_value(raw_value=ent_prop_dict['value'],
-                                           type_=type_)
+                                           type_=type_, blob_key=blob_key,
+                                           value_encoding=value_encoding)
         return ent_dicts
 
-    def query_ents(self, query=None, connection=None):
-        statement = self.get_ents_query_statement(query=query)
-        ent_prop_dicts = \
-                self.execute(statement, connection=connection).fetchall()
-        return self.ent_prop_dicts_to_ent_dicts(ent_prop_dicts=ent_prop_dicts)
+    def pivoted_rows_to_ent_dicts(self, rows=None, pivot_props=None):
+        ent_dicts = {}
+        for row in rows:
+            props = {}
+            for i, prop in enumerate(pivot_props):
+                raw_value = row['prop_%s_value' % i]
+                type_ = row['prop_%s_type' % i]
+                if raw_value is None and type_ is None: continue
+                props[prop] = self.deserialize_value(
+                    raw_value=raw_value, type_=type_,
+                    blob_key=row['prop_%s_blob_key' % i],
+                    value_encoding=row['prop_%s_value_encoding' % i])
+            ent_dicts[row['ent_key']] = {'key': row['ent_key'],
+                                         'modified': row['ent_modified'],
+                                         'props': props}
+        return ent_dicts
+
+    def result_rows_to_ent_dicts(self, rows=None, query_components=None):
+        if 'pivot_props' in query_components:
+            return self.pivoted_rows_to_ent_dicts(
+                rows=rows, pivot_props=query_components['pivot_props'])
+        return self.ent_prop_dicts_to_ent_dicts(ent_prop_dicts=rows)
+
+    def query_ents(self, query=None, format='ents', connection=None):
+        if format == 'columns':
+            return self.query_ents_columns(query=query, connection=connection)
+        prepared_query = self.prepare_ents_query(query=query)
+        ent_prop_dicts = self.execute_prepared_query(
+            prepared_query=prepared_query, connection=connection).fetchall()
+        ents = self.result_rows_to_ent_dicts(
+            rows=ent_prop_dicts,
+            query_components=prepared_query['query_components'])
+        if (query or {}).get('load_blobs'):
+            self.load_lazy_values(ents=ents, connection=connection)
+        return ents
+
+    def query_ents_columns(self, query=None, connection=None):
+        query = {**(query or {}), 'typed_values': True}
+        query.pop('pivot', None)
+        prepared_query = self.prepare_ents_query(query=query)
+        result_proxy = self.execute_prepared_query(
+            prepared_query=prepared_query, connection=connection)
+        return self.result_proxy_to_ent_columns(
+            result_proxy=result_proxy,
+            props=query.get('props_to_select'), connection=connection)
+
+    def result_proxy_to_ent_columns(self, result_proxy=None, props=None,
+                                    connection=None):
+        ent_keys = []
+        ent_idxs = {}
+        cells_by_prop = {prop: [] for prop in (props or [])}
+        blob_keys_by_prop = collections.defaultdict(dict)
+        (key_idx, prop_idx, value_idx, type_idx, blob_key_idx, encoding_idx,
+         *typed_idxs) = [
+            list(result_proxy.keys()).index(column_name) for column_name in
+            ['ent_key', 'prop', 'value', 'type', 'blob_key', 'value_encoding',
+             *self.TYPED_VALUE_COLUMNS]
+        ]
+        for row in result_proxy:
+            ent_key = row[key_idx]
+            ent_idx = ent_idxs.get(ent_key)
+            if ent_idx is None:
+                ent_idx = ent_idxs[ent_key] = len(ent_keys)
+                ent_keys.append(ent_key)
+            if row[prop_idx] is None: continue
+            cells = cells_by_prop.setdefault(row[prop_idx], [])
+            if row[blob_key_idx] is not None:
+                blob_keys_by_prop[row[prop_idx]][len(cells)] = \
+                        row[blob_key_idx]
+            raw_value = row[value_idx]
+            if row[encoding_idx] is not None:
+                raw_value = self.decompress_raw_value(
+                    raw_value=raw_value, value_encoding=row[encoding_idx])
+            cells.append((ent_idx, row[type_idx], raw_value,
+                          *[row[typed_idx] for typed_idx in typed_idxs]))
+        if blob_keys_by_prop:
+            # Column reads are bulk reads, so offloaded values load eagerly.
+            raw_values = self.load_blob_raw_values(
+                blob_keys=[blob_key for blob_keys in blob_keys_by_prop.values()
+                           for blob_key in blob_keys.values()],
+                connection=connection)
+            for prop, blob_keys in blob_keys_by_prop.items():
+                cells = cells_by_prop[prop]
+                for cell_idx, blob_key in blob_keys.items():
+                    cell = cells[cell_idx]
+                    cells[cell_idx] = (*cell[:2], raw_values[blob_key],
+                                       *cell[3:])
+        columns, types = {}, {}
+        for prop, cells in cells_by_prop.items():
+            types[prop], columns[prop] = self.cells_to_column(
+                cells=cells, size=len(ent_keys))
+        return {'ent_keys': ent_keys, 'types': types, 'columns': columns}
+
+    def cells_to_column(self, cells=None, size=None):
+        # Cells are (ent_idx, type, value, value_int, value_float, value_bool).
+        ent_idxs, types, values, ints, floats, bools = \
+                zip(*cells) if cells else ([],) * 6
+        type_set = {self.codec_registry.get_type_name(type_tag=type_)
+                    for type_ in types}
+        # An ent's rows needn't arrive together, so every column places its
+        # values by ent_idx rather than by arrival order.
+        complete = len(cells) == size
+        if type_set == {'int'} and complete and None not in ints:
+            return 'int', self.to_numeric_column(
+                values=ints, type_='int', ent_idxs=ent_idxs, size=size)
+        if type_set and type_set <= {'int', 'float'}:
+            floats = [
+                float_ if float_ is not None else float(value)
+                for float_, value in zip(floats, values)
+            ]
+            return 'float', self.to_numeric_column(
+                values=floats, type_='float', ent_idxs=ent_idxs, size=size)
+        if type_set == {'bool'} and complete:
+            column = [None] * size
+            for ent_idx, bool_ in zip(ent_idxs, bools): column[ent_idx] = bool_
+            if _np is not None: return 'bool', _np.array(column, dtype=bool)
+            return 'bool', column
+        column = [None] * size
+        if type_set == {'str'}: cell_values = values
+        else:
+            cell_values = [self.deserialize_value(raw_value=value, type_=type_)
+                           for value, type_ in zip(values, types)]
+        for ent_idx, cell_value in zip(ent_idxs, cell_values):
+            column[ent_idx] = cell_value
+        column_type = type_set.pop() if len(type_set) == 1 else 'object'
+        return column_type, column
+
+    def to_numeric_column(self, values=None, type_=None, ent_idxs=None,
+                          size=None):
+        # Missing cells are only supported in float columns, as NaN.
+        typecode = self.NUMERIC_COLUMN_TYPECODES[type_]
+        fill_value = math.nan if type_ == 'float' else 0
+        if _np is not None:
+            column = _np.full(size, fill_value, dtype=_np.dtype(typecode))
+            column[list(ent_idxs)] = values
+            return column
+        column = array.array(typecode, [fill_value]) * size
+        for ent_idx, value in zip(ent_idxs, values): column[ent_idx] = value
+        return column
+
+    def iter_ents(self, query=None, fetch_size=None, connection=None):
+        prepared_query = self.prepare_ents_query(query=query, ordered=True)
+        # A dedicated connection keeps the open cursor out of any session
+        # the caller may start between iterations.
+        owned_connection = None
+        connection = connection or self.current_connection
+        if connection is None:
+            connection = owned_connection = self.engine.connect()
+        try:
+            result_proxy = self.execute_prepared_query(
+                prepared_query=prepared_query,
+                connection=connection.execution_options(stream_results=True))
+            ent_prop_dicts = self._iter_result_proxy_rows(
+                result_proxy=result_proxy,
+                fetch_size=(fetch_size or self.ITER_ENTS_FETCH_SIZE))
+            for ent_key, ent_prop_dicts_for_ent in itertools.groupby(
+                ent_prop_dicts, key=lambda row: row['ent_key']):
+                yield self.result_rows_to_ent_dicts(
+                    rows=ent_prop_dicts_for_ent,
+                    query_components=prepared_query['query_components']
+                )[ent_key]
+        finally:
+            if owned_connection is not None: owned_connection.close()
+
+    def _iter_result_proxy_rows(self, result_proxy=None, fetch_size=None):
+        try:
+            while True:
+                rows = result_proxy.fetchmany(fetch_size)
+                if not rows: return
+                yield from rows
+        finally: result_proxy.close()
+
+    def query_ents_page(self, query=None, connection=None):
+        query = query or {}
+        prepared_query = self.prepare_ents_query(query=query)
+        ent_prop_dicts = self.execute_prepared_query(
+            prepared_query=prepared_query, connection=connection).fetchall()
+        ents = self.result_rows_to_ent_dicts(
+            rows=ent_prop_dicts,
+            query_components=prepared_query['query_components'])
+        if query.get('load_blobs'):
+            self.load_lazy_values(ents=ents, connection=connection)
+        cursor = None
+        if ent_prop_dicts and query.get('limit') and \
+           len(ents) >= query['limit']:
+            cursor = self.encode_cursor(sort_values=[
+                ent_prop_dicts[-1][sort_label] for sort_label in
+                prepared_query['query_components']['sort_labels']
+            ])
+        return {'ents': ents, 'cursor': cursor}
+
+    def count_ents(self, query=None, connection=None):
+        query_components = self.get_ents_query_components(
+            query=self.get_filter_query(query=query))
+        outer_ents = query_components['tables']['outer_ents']
+        statement = (
+            _sqla.select([_sqla.func.count(_sqla.distinct(outer_ents.c.key))])
+            .select_from(query_components['from'])
+            .where(_sqla.and_(*query_components['wheres']))
+        )
+        return self.execute(statement, connection=connection).scalar()
+
+    def aggregate(self, query=None, group_by=None, metrics=None,
+                  connection=None):
+        group_by = group_by or []
+        metrics = metrics or [{'op': 'count'}]
+        ent_keys = self.get_filtered_ent_keys_statement(query=query).alias(
+            'ent_keys')
+        props = self.schema['tables']['props']
+        from_ = ent_keys
+        columns = []
+        group_by_columns = []
+        for i, prop in enumerate(group_by):
+            group_props = props.alias('group_by_%s' % i)
+            from_ = from_.outerjoin(group_props, _sqla.and_(
+                group_props.c.ent_key == ent_keys.c.key,
+                group_props.c.prop == prop))
+            group_by_columns.extend([group_props.c.value, group_props.c.type,
+                                     group_props.c.value_encoding,
+                                     group_props.c.blob_key])
+        for i, metric in enumerate(metrics):
+            if metric['op'] not in self.AGGREGATE_OPS:
+                raise Exception("unknown metric op '{op}'".format(
+                    op=metric['op']))
+            if metric.get('prop') is None:
+                if metric['op'] != 'count':
+                    raise Exception(
+                        "metric op '{op}' requires a 'prop'".format(
+                            op=metric['op']))
+                columns.append(_sqla.func.count(ent_keys.c.key))
+                continue
+            metric_props = props.alias('metric_%s' % i)
+            from_ = from_.outerjoin(metric_props, _sqla.and_(
+                metric_props.c.ent_key == ent_keys.c.key,
+                metric_props.c.prop == metric['prop']))
+            # Numeric metrics read a typed column rather than text, as ints
+            # when the metric's type says so, the way order_by does.
+            metric_column = metric_props.c[self.FILTER_VALUE_COLUMNS.get(
+                metric.get('type'), 'value_float')]
+            if metric['op'] == 'count': metric_column = metric_props.c.ent_key
+            columns.append(self.AGGREGATE_OPS[metric['op']](metric_column))
+        statement = _sqla.select(group_by_columns + columns).select_from(from_)
+        if group_by_columns: statement = statement.group_by(*group_by_columns)
+        rows = self.execute(statement, connection=connection).fetchall()
+        # Group values offloaded to blobs are loaded in one batch.
+        blob_raw_values = self.load_blob_raw_values(blob_keys=[
+            row[4 * i + 3] for row in rows for i in range(len(group_by))
+            if row[4 * i + 3] is not None
+        ], connection=connection)
+        return [
+            {
+                'group_by': {
+                    prop: self.deserialize_value(
+                        raw_value=(row[4 * i] if row[4 * i + 3] is None
+                                   else blob_raw_values[row[4 * i + 3]]),
+                        type_=row[4 * i + 1], value_encoding=row[4 * i + 2])
+                    for i, prop in enumerate(group_by)
+                },
+                'metrics': {
+                    self.get_metric_label(metric=metric):
+                    row[len(group_by_columns) + i]
+                    for i, metric in enumerate(metrics)
+                },
+            }
+            for row in rows
+        ]
+
+    def get_metric_label(self, metric=None):
+        if metric.get('label'): return metric['label']
+        if metric.get('prop') is None: return metric['op']
+        return '%s_%s' % (metric['op'], metric['prop'])
+
+    def get_filtered_ent_keys_statement(self, query=None):
+        query_components = self.get_ents_query_components(
+            query=self.get_filter_query(query=query))
+        outer_ents = query_components['tables']['outer_ents']
+        return (
+            _sqla.select([outer_ents.c.key.label('key')])
+            .select_from(query_components['from'])
+            .where(_sqla.and_(*query_components['wheres']))
+            .distinct()
+        )
+
+    def get_filter_query(self, query=None):
+        return {key: value for key, value in (query or {}).items()
+                if key in ['prop_filters', 'ent_filters']}
+
+    def prepare_ents_query(self, query=None, ordered=False):
+        if self.statement_cache is None:
+            return {**self._build_prepared_query(query=query, ordered=ordered),
+                    'params': {}}
+        normalized_query = self.normalize_query(query=query)
+        shape_key = (normalized_query['shape_key'], ordered)
+        prepared_query = self.statement_cache.get(shape_key)
+        if prepared_query is None:
+            prepared_query = self._build_prepared_query(
+                query=normalized_query['query'], ordered=ordered)
+            self.statement_cache[shape_key] = prepared_query
+        return {**prepared_query, 'params': normalized_query['params']}
+
+    def _build_prepared_query(self, query=None, ordered=False):
+        query_components = self.get_ents_query_components(query=query)
+        if ordered and not query_components.get('order_by'):
+            outer_ents = query_components['tables']['outer_ents']
+            query_components = {**query_components,
+                                'order_by': [outer_ents.c.key]}
+        return {
+            'query_components': query_components,
+            'statement': self.query_components_to_statement(
+                query_components=query_components),
+        }
+
+    def execute_prepared_query(self, prepared_query=None, connection=None):
+        args = [prepared_query['statement']]
+        if prepared_query['params']: args.append(prepared_query['params'])
+        if self.compiled_cache is None:
+            return self.execute(*args, connection=connection)
+        connection = connection or self.current_connection
+        executor = self.engine if connection is None else connection
+        return executor.execution_options(
+            compiled_cache=self.compiled_cache).execute(*args)
+
+    def normalize_query(self, query=None):
+        params = {}
+        shape, bound_query = self._normalize_query_node(node=(query or {}),
+                                                        params=params)
+        return {'shape_key': json.dumps(shape, default=repr),
+                'query': bound_query, 'params': params}
+
+    def _normalize_query_node(self, node=None, params=None):
+        if isinstance(node, dict):
+            shape, bound_node = {}, {}
+            # Sorted traversal keeps param names stable across dict orders.
+            for key in sorted(node):
+                value = node[key]
+                if key == 'arg':
+                    param_name = 'arg_%s' % len(params)
+                    params[param_name] = value
+                    shape['arg'] = bound_node['arg_type'] = \
+                            self.get_filter_arg_type(filter_=node)
+                    bound_node['arg'] = _sqla.bindparam(
+                        param_name, expanding=isinstance(value, (list, tuple)))
+                elif key == 'cursor' and value is not None:
+                    if isinstance(value, str):
+                        value = self.decode_cursor(cursor=value)
+                    param_names = ['cursor_%s' % i for i in range(len(value))]
+                    params.update(zip(param_names, value))
+                    shape['cursor'] = len(value)
+                    bound_node['cursor'] = [_sqla.bindparam(param_name)
+                                            for param_name in param_names]
+                else:
+                    shape[key], bound_node[key] = self._normalize_query_node(
+                        node=value, params=params)
+            return shape, bound_node
+        if isinstance(node, (list, tuple)):
+            normalized_items = [
+                self._normalize_query_node(node=item, params=params)
+                for item in node
+            ]
+            return ([item[0] for item in normalized_items],
+                    [item[1] for item in normalized_items])
+        return node, node
 
     def get_ents_query_statement(self, query=None):
         query_components = self.get_ents_query_components(query=query)
@@ -171,20 +1314,94 @@ class Dao(object):
                 'wheres': query_components['wheres'] + [
                     outer_props.c.prop.in_(props_to_select)]
             }
-        prop_filters = query.get('prop_filters')
+        filter_trees = [
+            filter_ for filter_ in ((query.get('prop_filters') or []) +
+                                    (query.get('ent_filters') or []))
+            if self.is_filter_tree(filter_=filter_)
+        ]
+        prop_filters = [filter_ for filter_ in
+                        (query.get('prop_filters') or [])
+                        if not self.is_filter_tree(filter_=filter_)]
         if prop_filters:
-            for filter_ in prop_filters:
+            plan = self.plan_query(query={**query,
+                                          'prop_filters': prop_filters})
+            if plan['strategy'] == 'intersect':
                 query_components = \
-                        self._alter_ents_query_components_per_prop_filter(
-                            query_components=query_components, filter_=filter_)
-        else:
-            if 'from' in query_components:
-                query_components['from'].isouter = True
+                        self._alter_ents_query_components_for_intersect(
+                            query_components=query_components,
+                            prop_filters=plan['prop_filters'])
+            else:
+                for filter_ in plan['prop_filters']:
+                    query_components = \
+                            self._alter_ents_query_components_per_prop_filter(
+                                query_components=query_components,
+                                filter_=filter_,
+                                strategy=query.get('prop_filter_strategy'))
+        # Any prop filter, flat or in a tree, excludes prop-less ents, so
+        # only queries without one outer-join props.
+        if not query.get('prop_filters') and 'from' in query_components:
+            query_components['from'].isouter = True
         for filter_ in (query.get('ent_filters') or []):
+            if self.is_filter_tree(filter_=filter_): continue
             query_components = self._alter_ents_query_components_per_ent_filter(
                 query_components=query_components, filter_=filter_)
+        for filter_tree in filter_trees:
+            query_components = {
+                **query_components,
+                'wheres': query_components['wheres'] + [
+                    self.get_filter_tree_clause(
+                        query_components=query_components, node=filter_tree,
+                        strategy=query.get('prop_filter_strategy'))
+                ]
+            }
+        if query.get('typed_values'):
+            query_components = {
+                **query_components,
+                'columns': {
+                    **query_components['columns'],
+                    **{column_name: outer_props.c[column_name].label(
+                        column_name)
+                       for column_name in self.TYPED_VALUE_COLUMNS}
+                }
+            }
+        if any(query.get(key) is not None for key in self.PAGE_QUERY_KEYS):
+            query_components = self._alter_ents_query_components_for_page(
+                query_components=query_components, query=query)
+        if query.get('pivot'):
+            query_components = self._alter_ents_query_components_for_pivot(
+                query_components=query_components, query=query)
         return query_components
 
+    def _alter_ents_query_components_for_pivot(self, query_components=None,
+                                               query=None):
+        pivot_props = list(query.get('props_to_select') or [])
+        if not pivot_props:
+            raise Exception("pivot queries require 'props_to_select'")
+        outer_ents = query_components['tables']['outer_ents']
+        outer_props = query_components['tables']['outer_props']
+        columns = {
+            'ent_key': query_components['columns']['ent_key'],
+            'ent_modified': query_components['columns']['ent_modified'],
+        }
+        group_by = [outer_ents.c.key, outer_ents.c.modified]
+        for sort_label in query_components.get('sort_labels', []):
+            columns[sort_label] = query_components['columns'][sort_label]
+            group_by.append(columns[sort_label].element)
+        for i, prop in enumerate(pivot_props):
+            for column_name in ['value', 'type', 'blob_key',
+                                'value_encoding']:
+                label = 'prop_%s_%s' % (i, column_name)
+                columns[label] = _sqla.func.max(_sqla.case([(
+                    outer_props.c.prop == prop, outer_props.c[column_name]
+                )])).label(label)
+        altered_query_components = {
+            **query_components,
+            'columns': columns,
+            'group_by': group_by,
+            'pivot_props': pivot_props,
+        }
+        return altered_query_components
+
     def _get_ents_base_query_components(self):
         query_components = {
             'tables': {
@@ -202,6 +1419,9 @@ class Dao(object):
                 'prop': outer_props.c.prop.label('prop'),
                 'value': outer_props.c.value.label('value'),
                 'type': outer_props.c.type.label('type'),
+                'blob_key': outer_props.c.blob_key.label('blob_key'),
+                'value_encoding': outer_props.c.value_encoding.label(
+                    'value_encoding'),
                 'ent_key': outer_ents.c.key.label('ent_key'),
                 'ent_modified': outer_ents.c.modified.label('ent_modified'),
             },
@@ -210,20 +1430,94 @@ class Dao(object):
         })
         return query_components
 
+    def analyze(self, connection=None):
+        if self.planner is None: self.planner = planner.QueryPlanner(dao=self)
+        prop_stats = self.planner.analyze(connection=connection)
+        # Cached statements were planned against the previous stats.
+        if self.statement_cache is not None:
+            self.statement_cache.clear()
+            self.compiled_cache.clear()
+        return prop_stats
+
+    def is_filter_tree(self, filter_=None):
+        return any(key in filter_ for key in self.FILTER_TREE_OPS)
+
+    def get_filter_tree_clause(self, query_components=None, node=None,
+                               strategy=None):
+        if not self.is_filter_tree(filter_=node):
+            if 'col' in node:
+                return self.get_where_clause_for_binary_filter(
+                    column=query_components['tables']['outer_ents'].c[
+                        node['col']],
+                    filter_=node)
+            return self.get_prop_filter_where_clause(
+                query_components=query_components, filter_=node,
+                strategy=strategy)
+        if 'not' in node:
+            # Unlike a '! ' op, 'not' also matches ents that lack the prop.
+            return ~self.get_filter_tree_clause(
+                query_components=query_components, node=node['not'],
+                strategy=strategy)
+        op = 'and' if 'and' in node else 'or'
+        child_clauses = [
+            self.get_filter_tree_clause(query_components=query_components,
+                                        node=child, strategy=strategy)
+            for child in node[op]
+        ]
+        if op == 'and': return _sqla.and_(_sqla.true(), *child_clauses)
+        return _sqla.or_(_sqla.false(), *child_clauses)
+
+    def plan_query(self, query=None):
+        if self.planner is not None and self.planner.analyzed:
+            return self.planner.plan(query=query)
+        prop_filters = (query or {}).get('prop_filters') or []
+        return {'strategy': 'join', 'prop_filters': prop_filters,
+                'estimated_rows': [None] * len(prop_filters)}
+
+    def explain(self, query=None):
+        statement = self.get_ents_query_statement(query=query)
+        return {**self.plan_query(query=query),
+                'sql': str(statement.compile(dialect=self.engine.dialect))}
+
+    def _alter_ents_query_components_for_intersect(
+        self, query_components=None, prop_filters=None):
+        ent_key_selects = []
+        for filter_ in prop_filters:
+            props = query_components['tables']['props'].alias()
+            if self.get_filter_type(filter_=filter_) == 'existence':
+                where_clause = props.c.prop == filter_['prop']
+            else:
+                where_clause = self.get_prop_filter_clause(table=props,
+                                                           filter_=filter_)
+            ent_key_selects.append(
+                _sqla.select([props.c.ent_key]).where(where_clause))
+        matching_ents = _sqla.intersect(*ent_key_selects).alias(
+            'matching_ents')
+        outer_ents = query_components['tables']['outer_ents']
+        altered_query_components = {
+            **query_components,
+            'from': query_components['from'].join(
+                matching_ents, matching_ents.c.ent_key == outer_ents.c.key)
+        }
+        return altered_query_components
+
     def _alter_ents_query_components_per_prop_filter(
-        self, query_components=None, filter_=None):
+        self, query_components=None, filter_=None, strategy=None):
         filter_type = self.get_filter_type(filter_=filter_)
         alter_fn = None
+        alter_kwargs = {}
         if filter_type == 'binary':
             alter_fn = self._alter_ents_query_components_per_prop_binary_filter
+            alter_kwargs['strategy'] = strategy
         elif filter_type == 'existence':
             alter_fn = \
                     self._alter_ents_query_components_per_prop_existence_filter
-        return alter_fn(query_components=query_components, filter_=filter_)
+        return alter_fn(query_components=query_components, filter_=filter_,
+                        **alter_kwargs)
 
     def get_filter_type(self, filter_=None):
         filter_type = None
-        op = filter_['op'].lstrip('! ')
+        op = self.parse_op(op=filter_['op'])['op']
         if op in self.BINARY_OPS: filter_type = 'binary'
         elif op == self.EXISTENCE_OP: filter_type = 'existence'
         else: raise Exception(
@@ -231,44 +1525,115 @@ class Dao(object):
         return filter_type
 
     def _alter_ents_query_components_per_prop_binary_filter(
-        self, query_components=None, filter_=None):
-        props = query_components['tables']['props'].alias()
-        subq = (
-            props.select()
-            .where(props.c.prop == filter_['prop'])
-            .where(self.get_where_clause_for_binary_filter(
-                column=props.c.value, filter_=filter_))
-        ).alias()
+        self, query_components=None, filter_=None, strategy=None):
+        strategy = strategy or self.prop_filter_strategy
+        if strategy not in self.PROP_FILTER_STRATEGIES:
+            raise Exception("unknown prop filter strategy '{strategy}'".format(
+                strategy=strategy))
+        if strategy == 'join':
+            props = query_components['tables']['props'].alias()
+            subq = (
+                props.select()
+                .where(self.get_prop_filter_clause(table=props,
+                                                   filter_=filter_))
+            ).alias()
+            return {
+                **query_components,
+                'from': query_components['from'].join(subq)
+            }
         altered_query_components = {
             **query_components,
-            'from': query_components['from'].join(subq)
+            'wheres': query_components['wheres'] + [
+                self.get_prop_filter_where_clause(
+                    query_components=query_components, filter_=filter_,
+                    strategy=strategy)
+            ]
         }
         return altered_query_components
 
+    def get_prop_filter_where_clause(self, query_components=None, filter_=None,
+                                     strategy=None):
+        props = query_components['tables']['props'].alias()
+        outer_ent_key = query_components['tables']['outer_ents'].c.key
+        if self.get_filter_type(filter_=filter_) == 'existence':
+            exists_clause = _sqla.exists(
+                _sqla.select([props.c.ent_key])
+                .where(props.c.prop == filter_['prop'])
+                .where(props.c.ent_key == outer_ent_key)
+            )
+            if self.parse_op(op=filter_['op'])['negated']:
+                exists_clause = ~exists_clause
+            return exists_clause
+        ent_keys = (
+            _sqla.select([props.c.ent_key])
+            .where(self.get_prop_filter_clause(table=props, filter_=filter_))
+        )
+        if (strategy or self.prop_filter_strategy) == 'in_subquery':
+            return outer_ent_key.in_(ent_keys)
+        return _sqla.exists(ent_keys.where(props.c.ent_key == outer_ent_key))
+
+    def get_prop_filter_clause(self, table=None, filter_=None):
+        column = self.get_value_column_for_filter(table=table, filter_=filter_)
+        value_clause = self.get_where_clause_for_binary_filter(
+            column=column, filter_=filter_)
+        if column is table.c.value_int:
+            # Floats, and ints beyond value_int's range, only have a
+            # value_float, so int args compare against that as a fallback.
+            # The coercion keeps a shared arg bindparam bound as an int.
+            value_clause = _sqla.or_(value_clause, _sqla.and_(
+                table.c.value_int.is_(None),
+                self.get_where_clause_for_binary_filter(
+                    column=_sqla.type_coerce(table.c.value_float,
+                                             table.c.value_int.type),
+                    filter_=filter_)
+            ))
+        return _sqla.and_(table.c.prop == filter_['prop'], value_clause)
+
+    def get_value_column_for_filter(self, table=None, filter_=None):
+        if self.parse_op(op=filter_['op'])['op'] == 'LIKE': return table.c.value
+        column_name = self.FILTER_VALUE_COLUMNS.get(
+            self.get_filter_arg_type(filter_=filter_), 'value')
+        return table.c[column_name]
+
+    def get_filter_arg_type(self, filter_=None):
+        if filter_.get('arg_type'): return filter_['arg_type']
+        arg = filter_.get('arg')
+        if not isinstance(arg, (list, tuple)):
+            return self.get_arg_type(arg=arg)
+        # IN lists compare against one value column, so they need one type.
+        arg_types = {self.get_arg_type(arg=item) for item in arg}
+        if len(arg_types) > 1:
+            raise Exception("mixed arg types in filter '{filter}'".format(
+                filter=filter_))
+        return arg_types.pop() if arg_types else 'str'
+
+    def get_arg_type(self, arg=None):
+        arg_type = type(arg).__name__
+        # Ints beyond value_int's range are only stored as value_float.
+        if arg_type == 'int' and abs(arg) > self.MAX_VALUE_INT: return 'float'
+        return arg_type
+
     def get_where_clause_for_binary_filter(self, column=None, filter_=None):
         parsed_op = self.parse_op(op=filter_['op'])
-        clause = column.op(parsed_op['op'])(filter_['arg'])
+        if parsed_op['op'] == 'IN': clause = column.in_(filter_['arg'])
+        else: clause = column.op(parsed_op['op'])(filter_['arg'])
         if parsed_op['negated']: clause = ~clause
         return clause
 
     def parse_op(self, op=None):
-        groups = re.match(r'(! )?(.*)', op).groups()
-        return {'negated': groups[0] is not None, 'op': groups[1]}
+        # Accepts '! =', '!=', 'NOT IN', 'not like' and so on.
+        groups = self.OP_PATTERN.match(op).groups()
+        return {'negated': groups[0] is not None or groups[1] is not None,
+                'op': groups[2].upper()}
 
     def _alter_ents_query_components_per_prop_existence_filter(
         self, query_components=None, filter_=None):
-        props = query_components['tables']['props'].alias()
-        outer_ent_key = query_components['tables']['outer_ents'].c.key
-        exists_clause = _sqla.exists(
-            _sqla.select([props.c.ent_key])
-            .where(props.c.prop == filter_['prop'])
-            .where(props.c.ent_key == outer_ent_key)
-        )
-        parsed_op = self.parse_op(filter_['op'])
-        if parsed_op['negated']: exists_clause = ~exists_clause
         altered_query_components = {
             **query_components,
-            'wheres': query_components['wheres'] + [exists_clause]
+            'wheres': query_components['wheres'] + [
+                self.get_prop_filter_where_clause(
+                    query_components=query_components, filter_=filter_)
+            ]
         }
         return altered_query_components
 
@@ -284,22 +1649,271 @@ class Dao(object):
         }
         return altered_query_components
 
+    def _alter_ents_query_components_for_page(self, query_components=None,
+                                              query=None):
+        outer_ents = query_components['tables']['outer_ents']
+        sort_specs = self.get_sort_specs(query_components=query_components,
+                                         order_by=query.get('order_by'))
+        page_from = query_components['from']
+        page_wheres = list(query_components['wheres'])
+        for sort_spec in sort_specs:
+            if 'join' in sort_spec:
+                page_from = page_from.outerjoin(*sort_spec['join'])
+        if query.get('cursor') is not None:
+            page_wheres.append(self.get_keyset_clause(
+                sort_specs=sort_specs, cursor=query['cursor']))
+        sort_labels = ['sort_%s' % i for i in range(len(sort_specs))]
+        page_statement = (
+            _sqla.select([sort_spec['column'].label(sort_label)
+                          for sort_spec, sort_label in zip(sort_specs,
+                                                           sort_labels)])
+            .select_from(page_from)
+            .where(_sqla.and_(*page_wheres))
+            .distinct()
+            .order_by(*self.get_orderings(
+                columns=[sort_spec['column'] for sort_spec in sort_specs],
+                sort_specs=sort_specs))
+        )
+        if query.get('limit') is not None:
+            page_statement = page_statement.limit(query['limit'])
+        page = page_statement.alias('page')
+        page_columns = [page.c[sort_label] for sort_label in sort_labels]
+        altered_query_components = {
+            **query_components,
+            'columns': {
+                **query_components['columns'],
+                **{sort_label: page_column.label(sort_label)
+                   for sort_label, page_column in zip(sort_labels,
+                                                      page_columns)}
+            },
+            'from': query_components['from'].join(
+                page, page_columns[-1] == outer_ents.c.key),
+            'order_by': self.get_orderings(columns=page_columns,
+                                           sort_specs=sort_specs),
+            'sort_labels': sort_labels,
+        }
+        return altered_query_components
+
+    def get_sort_specs(self, query_components=None, order_by=None):
+        outer_ents = query_components['tables']['outer_ents']
+        sort_specs = []
+        for order_spec in (order_by or []):
+            if 'prop' in order_spec:
+                sort_props = query_components['tables']['props'].alias()
+                column = sort_props.c[self.FILTER_VALUE_COLUMNS.get(
+                    order_spec.get('type'), 'value')]
+                # Ents sans the prop (or sans a value of the sort type) sort
+                # last in either direction, via a leading is-null flag.
+                sort_specs.extend([
+                    {'column': _sqla.case(
+                        [(column.is_(None), _sqla.literal_column('1'))],
+                        else_=_sqla.literal_column('0')),
+                     'desc': False,
+                     'join': [sort_props,
+                              (sort_props.c.ent_key == outer_ents.c.key)
+                              & (sort_props.c.prop == order_spec['prop'])]},
+                    {'column': column, 'desc': order_spec.get('desc', False),
+                     'nullable': True},
+                ])
+            else:
+                sort_specs.append({'column': outer_ents.c[order_spec['col']],
+                                   'desc': order_spec.get('desc', False)})
+        # The ent key breaks ties, so that keyset cursors are unambiguous.
+        if not (order_by and order_by[-1].get('col') == 'key'):
+            sort_specs.append({'column': outer_ents.c.key, 'desc': False})
+        return sort_specs
+
+    def get_orderings(self, columns=None, sort_specs=None):
+        return [column.desc() if sort_spec['desc'] else column.asc()
+                for column, sort_spec in zip(columns, sort_specs)]
+
+    def get_keyset_clause(self, sort_specs=None, cursor=None):
+        if isinstance(cursor, str): cursor = self.decode_cursor(cursor=cursor)
+        clauses = []
+        for i, sort_spec in enumerate(sort_specs):
+            column = sort_spec['column']
+            # Nulls sort last, so nothing in their column sorts after them.
+            if cursor[i] is None: continue
+            if sort_spec['desc']: comparison = column < cursor[i]
+            else: comparison = column > cursor[i]
+            clauses.append(_sqla.and_(*[
+                self.get_sort_equality_clause(sort_spec=sort_specs[j],
+                                              value=cursor[j])
+                for j in range(i)
+            ], comparison))
+        return _sqla.or_(*clauses)
+
+    def get_sort_equality_clause(self, sort_spec=None, value=None):
+        if sort_spec.get('nullable'):
+            return sort_spec['column'].isnot_distinct_from(value)
+        return sort_spec['column'] == value
+
+    def encode_cursor(self, sort_values=None):
+        return base64.urlsafe_b64encode(
+            json.dumps(sort_values).encode()).decode()
+
+    def decode_cursor(self, cursor=None):
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
     def query_components_to_statement(self, query_components=None):
         statement = (
             _sqla.select(list(query_components['columns'].values()))
             .select_from(query_components['from'])
             .where(_sqla.and_(*query_components['wheres']))
         )
+        if query_components.get('group_by'):
+            statement = statement.group_by(*query_components['group_by'])
+        if query_components.get('order_by'):
+            statement = statement.order_by(*query_components['order_by'])
         return statement
 
     def upsert_ent(self, ent_key=None, patches=None, deletions=None,
                    connection=None):
-        connection = connection or self.connection
-        with connection.begin():
-            try:
-                return self.create_ent(ent_key=ent_key, props=patches,
-                                       connection=connection)
-            except _sqla_exc.IntegrityError:
-                return self.update_ent(ent_key=ent_key, patches=patches,
-                                       deletions=deletions,
-                                       connection=connection)
+        self.upsert_ents(ents=[{'key': ent_key, 'patches': patches,
+                                'deletions': deletions}],
+                         connection=connection)
+
+    def upsert_ents(self, ents=None, batch_size=None, connection=None):
+        batch_size = batch_size or self.UPSERT_ENTS_BATCH_SIZE
+        with self._connection_scope(connection=connection) as connection:
+            ent_keys = []
+            for batch in iter_batches(items=ents, batch_size=batch_size):
+                try:
+                    with connection.begin():
+                        batch_ent_keys = self._upsert_ents_batch(
+                            ents=batch, connection=connection)
+                finally:
+                    self.notify_ents_written(ent_keys=[
+                        ent.get('key') for ent in batch
+                        if ent.get('key') is not None
+                    ])
+                ent_keys.extend(batch_ent_keys)
+            return ent_keys
+
+    def _upsert_ents_batch(self, ents=None, connection=None):
+        ent_keys = [
+            ent.get('key') if ent.get('key') is not None
+            else self.generate_key()
+            for ent in ents
+        ]
+        merged_ents = self.merge_upsert_ents(ents=[
+            {**ent, 'key': ent_key} for ent, ent_key in zip(ents, ent_keys)
+        ])
+        deletions_by_ent_key = {}
+        prop_values = []
+        for ent_key, merged_ent in merged_ents.items():
+            if merged_ent['deletions']:
+                deletions_by_ent_key[ent_key] = merged_ent['deletions']
+            prop_values.extend(self.get_prop_values(
+                ent_key=ent_key, props=merged_ent['patches']))
+        self.save_blobs(prop_values=prop_values, connection=connection)
+        if connection.dialect.name in self.NATIVE_UPSERT_DIALECTS:
+            upsert_rows_fn = self._upsert_rows_natively
+        else: upsert_rows_fn = self._upsert_rows_generically
+        upsert_rows_fn(ent_keys=list(merged_ents), prop_values=prop_values,
+                       connection=connection)
+        if deletions_by_ent_key:
+            props_table = self.schema['tables']['props']
+            self.execute(props_table.delete().where(_sqla.or_(*[
+                (props_table.c.ent_key == ent_key)
+                & props_table.c.prop.in_(deletions)
+                for ent_key, deletions in deletions_by_ent_key.items()
+            ])), connection=connection)
+        return ent_keys
+
+    def merge_upsert_ents(self, ents=None):
+        # A multi-row upsert can't touch one row twice (postgres rejects
+        # it), so repeated keys merge into one upsert, applied in order.
+        merged_ents = {}
+        for ent in ents:
+            merged_ent = merged_ents.setdefault(
+                ent['key'], {'patches': {}, 'deletions': []})
+            deletions = ent.get('deletions') or []
+            for prop, value in (ent.get('patches') or {}).items():
+                if prop in deletions: continue
+                merged_ent['patches'][prop] = value
+                if prop in merged_ent['deletions']:
+                    merged_ent['deletions'].remove(prop)
+            for prop in deletions:
+                merged_ent['patches'].pop(prop, None)
+                if prop not in merged_ent['deletions']:
+                    merged_ent['deletions'].append(prop)
+        return merged_ents
+
+    def _upsert_rows_natively(self, ent_keys=None, prop_values=None,
+                              connection=None):
+        ents = self.schema['tables']['ents']
+        props_table = self.schema['tables']['props']
+        dialect_name = connection.dialect.name
+        ent_values = [{'key': ent_key} for ent_key in ent_keys]
+        modified = schema._int_time()
+        if dialect_name == 'postgresql':
+            ents_statement = _sqla_postgresql.insert(ents).values(ent_values)\
+                    .on_conflict_do_update(index_elements=[ents.c.key],
+                                           set_={'modified': modified})
+            props_statement = _sqla_postgresql.insert(props_table)
+            props_statement = props_statement.on_conflict_do_update(
+                index_elements=[props_table.c.ent_key, props_table.c.prop],
+                set_={column: props_statement.excluded[column]
+                      for column in self.UPSERT_PROP_COLUMNS}
+            )
+        elif dialect_name == 'mysql':
+            ents_statement = _sqla_mysql.insert(ents).values(ent_values)\
+                    .on_duplicate_key_update(modified=modified)
+            props_statement = _sqla_mysql.insert(props_table)
+            props_statement = props_statement.on_duplicate_key_update(**{
+                column: props_statement.inserted[column]
+                for column in self.UPSERT_PROP_COLUMNS
+            })
+        else:
+            self.execute(ents.insert().prefix_with('OR IGNORE')
+                         .values(ent_values), connection=connection)
+            ents_statement = ents.update().where(ents.c.key.in_(ent_keys))\
+                    .values(modified=modified)
+            props_statement = props_table.insert().prefix_with('OR REPLACE')
+        self.execute(ents_statement, connection=connection)
+        if prop_values:
+            self.execute(props_statement, prop_values, connection=connection)
+
+    def _upsert_rows_generically(self, ent_keys=None, prop_values=None,
+                                 connection=None):
+        ents = self.schema['tables']['ents']
+        props_table = self.schema['tables']['props']
+        existing_ent_keys = {
+            row['key'] for row in self.execute(
+                _sqla.select([ents.c.key]).where(ents.c.key.in_(ent_keys)),
+                connection=connection
+            ).fetchall()
+        }
+        new_ent_values = [{'key': ent_key} for ent_key in ent_keys
+                          if ent_key not in existing_ent_keys]
+        if new_ent_values:
+            self.execute(ents.insert(), new_ent_values, connection=connection)
+        if existing_ent_keys:
+            self.execute(
+                ents.update().where(ents.c.key.in_(existing_ent_keys)),
+                connection=connection)
+            props_to_replace = collections.defaultdict(list)
+            for prop_value in prop_values:
+                if prop_value['ent_key'] in existing_ent_keys:
+                    props_to_replace[prop_value['ent_key']].append(
+                        prop_value['prop'])
+            for ent_key, props_to_delete in props_to_replace.items():
+                self.delete_props(ent_key=ent_key,
+                                  props_to_delete=props_to_delete,
+                                  connection=connection)
+        if prop_values:
+            self.execute(props_table.insert(), prop_values,
+                         connection=connection)
+
+def is_in_memory_sqlite_url(url=None):
+    url = _sqla.engine.url.make_url(url)
+    return (url.get_backend_name() == 'sqlite'
+            and url.database in (None, '', ':memory:'))
+
+def iter_batches(items=None, batch_size=None):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if not batch: return
+        yield batch
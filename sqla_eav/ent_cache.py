@@ -0,0 +1,83 @@
+import copy
+import time
+
+from .utils.cache_utils import LRUCache
+
+
+class LRUBackend(object):
+    def __init__(self, max_size=10000, ttl=None, copy_values=True):
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+        self.copy_values = copy_values
+
+    def get(self, key):
+        value = self.cache.get(key)
+        if value is not None and self.copy_values: value = copy.deepcopy(value)
+        return value
+
+    def set(self, key, value):
+        if self.copy_values: value = copy.deepcopy(value)
+        self.cache[key] = value
+
+    def delete(self, key): self.cache.pop(key)
+
+    def clear(self): self.cache.clear()
+
+class SharedDictBackend(object):
+    # Wraps any mutable mapping, e.g. a multiprocessing.Manager().dict()
+    # shared by several worker processes.
+    def __init__(self, shared_dict=None, ttl=None):
+        self.shared_dict = shared_dict if shared_dict is not None else {}
+        self.ttl = ttl
+
+    def get(self, key):
+        try: value, expires_at = self.shared_dict[key]
+        except KeyError: return None
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value):
+        expires_at = None
+        if self.ttl is not None: expires_at = time.time() + self.ttl
+        self.shared_dict[key] = (value, expires_at)
+
+    def delete(self, key): self.shared_dict.pop(key, None)
+
+    def clear(self): self.shared_dict.clear()
+
+class EntCache(object):
+    def __init__(self, dao=None, backend=None, validate=True):
+        self.dao = dao
+        self.backend = backend or LRUBackend()
+        self.validate = validate
+        self.dao.add_write_listener(self.invalidate)
+
+    def get_ent(self, key=None, connection=None):
+        return self.get_ents(keys=[key], connection=connection).get(key)
+
+    def get_ents(self, keys=None, connection=None):
+        ents = {}
+        for key in keys:
+            ent = self.backend.get(key)
+            if ent is not None: ents[key] = ent
+        if ents and self.validate:
+            ents_modified = self.dao.get_ents_modified(ent_keys=list(ents),
+                                                       connection=connection)
+            for key, ent in list(ents.items()):
+                if ents_modified.get(key) != ent['modified']:
+                    del ents[key]
+                    self.backend.delete(key)
+        missing_keys = [key for key in keys if key not in ents]
+        if missing_keys:
+            fetched_ents = self.dao.get_ents(keys=missing_keys,
+                                             connection=connection)
+            # Lazy blob values hold the dao, so they can't be pickled into
+            # shared backends; cache the resolved values instead.
+            self.dao.load_lazy_values(ents=fetched_ents, connection=connection)
+            for key, ent in fetched_ents.items(): self.backend.set(key, ent)
+            ents.update(fetched_ents)
+        return {key: ents[key] for key in keys if key in ents}
+
+    def invalidate(self, ent_keys=None):
+        for key in ent_keys: self.backend.delete(key)
@@ -0,0 +1,86 @@
+import sqlalchemy as _sqla
+
+
+class QueryPlanner(object):
+    # Fallback selectivities for ops whose matches can't be read off the
+    # stats, in the spirit of the defaults most databases use.
+    RANGE_OP_SELECTIVITY = 1 / 3
+    LIKE_OP_SELECTIVITY = 1 / 4
+    RANGE_OPS = ['<', '>', '<=', '>=']
+    # Normalized IN args are bound at execution time, so plans assume a
+    # typical list length.
+    IN_OP_ARG_COUNT = 10
+    # Intersect key sets only when even the narrowest filter keeps more than
+    # this share of ents; otherwise joining from the narrowest is cheaper.
+    INTERSECT_MIN_SELECTIVITY = 0.1
+    INTERSECT_DIALECTS = ['postgresql', 'sqlite', 'oracle', 'mssql']
+
+    def __init__(self, dao=None):
+        self.dao = dao
+        self.prop_stats = None
+        self.ent_count = None
+
+    @property
+    def analyzed(self): return self.prop_stats is not None
+
+    def analyze(self, connection=None):
+        props = self.dao.schema['tables']['props']
+        ents = self.dao.schema['tables']['ents']
+        rows = self.dao.execute(
+            _sqla.select([props.c.prop, _sqla.func.count(),
+                          _sqla.func.count(_sqla.distinct(props.c.value))])
+            .group_by(props.c.prop),
+            connection=connection
+        ).fetchall()
+        self.prop_stats = {
+            prop: {'rows': row_count, 'distinct_values': distinct_count}
+            for prop, row_count, distinct_count in rows
+        }
+        self.ent_count = self.dao.execute(
+            _sqla.select([_sqla.func.count()]).select_from(ents),
+            connection=connection
+        ).scalar()
+        return self.prop_stats
+
+    def plan(self, query=None):
+        # Plans only read filter shapes, never arg values, so cached
+        # statements stay valid for every query of the same shape.
+        estimates = [
+            {'filter': filter_, 'rows': self.estimate_filter_rows(filter_)}
+            for filter_ in ((query or {}).get('prop_filters') or [])
+        ]
+        estimates.sort(key=lambda estimate: estimate['rows'])
+        return {
+            'strategy': self.get_strategy(estimates=estimates),
+            'prop_filters': [estimate['filter'] for estimate in estimates],
+            'estimated_rows': [estimate['rows'] for estimate in estimates],
+        }
+
+    def get_strategy(self, estimates=None):
+        if len(estimates) < 2 or not self.ent_count: return 'join'
+        if self.dao.engine.dialect.name not in self.INTERSECT_DIALECTS:
+            return 'join'
+        if any(self.dao.parse_op(op=estimate['filter']['op'])['negated'] and
+               self.dao.get_filter_type(filter_=estimate['filter']) ==
+               'existence' for estimate in estimates):
+            return 'join'
+        min_selectivity = estimates[0]['rows'] / self.ent_count
+        if min_selectivity > self.INTERSECT_MIN_SELECTIVITY: return 'intersect'
+        return 'join'
+
+    def estimate_filter_rows(self, filter_=None):
+        stats = self.prop_stats.get(filter_['prop'])
+        if stats is None: return 0
+        rows = stats['rows']
+        parsed_op = self.dao.parse_op(op=filter_['op'])
+        if self.dao.get_filter_type(filter_=filter_) == 'existence':
+            return (self.ent_count - rows) if parsed_op['negated'] else rows
+        if parsed_op['op'] == '=':
+            matched = rows / max(stats['distinct_values'], 1)
+        elif parsed_op['op'] == 'IN':
+            matched = min(rows, rows * self.IN_OP_ARG_COUNT /
+                          max(stats['distinct_values'], 1))
+        elif parsed_op['op'] in self.RANGE_OPS:
+            matched = rows * self.RANGE_OP_SELECTIVITY
+        else: matched = rows * self.LIKE_OP_SELECTIVITY
+        return (rows - matched) if parsed_op['negated'] else matched
@@ -10,22 +10,61 @@ def generate_schema():
     schema['tables']['ents'] = _sqla.Table(
         'ents', schema['metadata'],
         generate_key_column(),
-        *generate_timestamp_columns()
+        *generate_timestamp_columns(),
+        _sqla.Index('ix_ents_modified_key', 'modified', 'key'),
     )
     schema['tables']['props'] = _sqla.Table(
         'props', schema['metadata'],
         generate_key_column(),
-        _sqla.Column('ent_key', None, _sqla.ForeignKey('ents.key'),
-                     index=True),
-        _sqla.Column('prop', _sqla_types.String(length=1024),
-                     index=True),
+        _sqla.Column('ent_key', None, _sqla.ForeignKey('ents.key')),
+        _sqla.Column('prop', _sqla_types.String(length=1024)),
         _sqla.Column('value', _sqla_types.Text(),
                      nullable=True),
         _sqla.Column('type', _sqla_types.String(length=16), nullable=True),
-        generate_modified_column()
+        *generate_typed_value_columns(),
+        _sqla.Column('blob_key', None, _sqla.ForeignKey('blobs.key'),
+                     nullable=True),
+        _sqla.Column('value_size', _sqla_types.Integer(), nullable=True),
+        _sqla.Column('value_encoding', _sqla_types.String(length=64),
+                     nullable=True),
+        generate_modified_column(),
+        _sqla.Index('ux_props_ent_key_prop', 'ent_key', 'prop', unique=True,
+                    mysql_length={'prop': 255}),
+        _sqla.Index('ix_props_prop_value_int', 'prop', 'value_int'),
+        _sqla.Index('ix_props_prop_value_float', 'prop', 'value_float'),
+    )
+    schema['tables']['blobs'] = _sqla.Table(
+        'blobs', schema['metadata'],
+        _sqla.Column('key', _sqla_types.String(length=64), primary_key=True),
+        _sqla.Column('encoding', _sqla_types.String(length=16)),
+        _sqla.Column('size', _sqla_types.Integer()),
+        _sqla.Column('data', _sqla_types.LargeBinary()),
+        generate_created_column(),
+    )
+    schema['tables']['tombstones'] = _sqla.Table(
+        'tombstones', schema['metadata'],
+        generate_key_column(),
+        _sqla.Column('ent_key', _sqla_types.String(length=255)),
+        _sqla.Column('deleted', _sqla_types.Integer(), default=_int_time),
+        _sqla.Index('ix_tombstones_deleted_ent_key', 'deleted', 'ent_key'),
+    )
+    schema['tables']['compression_dicts'] = _sqla.Table(
+        'compression_dicts', schema['metadata'],
+        generate_key_column(),
+        _sqla.Column('encoding', _sqla_types.String(length=16)),
+        _sqla.Column('data', _sqla_types.LargeBinary()),
+        generate_created_column(),
     )
     return schema
 
+def generate_typed_value_columns():
+    return [
+        _sqla.Column('value_int', _sqla_types.BigInteger(), nullable=True),
+        _sqla.Column('value_float', _sqla_types.Float(precision=53),
+                     nullable=True),
+        _sqla.Column('value_bool', _sqla_types.Boolean(), nullable=True),
+    ]
+
 def generate_key_column():
     return _sqla.Column('key', _sqla_types.String(length=255),
                         primary_key=True, default=generate_key)
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from .. import async_dao
+
+class BaseTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.async_dao = self.generate_async_dao()
+        self.addCleanup(self.async_dao.dao.engine.dispose)
+        self.addCleanup(self.async_dao.close)
+        await self.async_dao.create_tables()
+
+    def generate_async_dao(self):
+        return async_dao.AsyncDao(db_uri='sqlite://', max_workers=4)
+
+class FileBaseTestCase(BaseTestCase):
+    def generate_async_dao(self):
+        # A file db lets several workers run calls concurrently.
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        return async_dao.AsyncDao(
+            db_uri='sqlite:///%s' % os.path.join(tmp_dir.name, 'test.db'),
+            max_workers=4)
+
+class AsyncDaoTestCase(BaseTestCase):
+    async def test_creates_and_gets_ents(self):
+        ent = await self.async_dao.create_ent(ent_key='ent_0',
+                                              props={'idx': 0})
+        self.assertEqual(ent['props'], {'idx': 0})
+        self.assertEqual(await self.async_dao.get_ent(key='ent_0'), ent)
+
+    async def test_updates_and_upserts_ents(self):
+        await self.async_dao.create_ent(ent_key='ent_0', props={'idx': 0})
+        await self.async_dao.update_ent(ent_key='ent_0', patches={'idx': 1})
+        await self.async_dao.upsert_ent(ent_key='ent_1', patches={'idx': 2})
+        ents = await self.async_dao.query_ents()
+        self.assertEqual({key: ent['props'] for key, ent in ents.items()},
+                         {'ent_0': {'idx': 1}, 'ent_1': {'idx': 2}})
+
+    async def test_rejects_in_memory_daos_sans_static_pool(self):
+        with self.assertRaises(ValueError):
+            async_dao.AsyncDao(dao=async_dao._dao.Dao(db_uri='sqlite://'))
+
+    async def test_executes_sql(self):
+        await self.async_dao.create_ents(ents=[
+            {'key': 'ent_%s' % i, 'props': {'idx': i}} for i in range(3)])
+        self.assertEqual(
+            await self.async_dao.execute_sql(
+                sql='SELECT COUNT(*) AS count FROM ents'),
+            [{'count': 3}])
+
+class GatherTestCase(BaseTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await self.async_dao.create_ents(ents=[
+            {'key': 'ent_%s' % i, 'props': {'idx': i, 'parity': i % 2}}
+            for i in range(10)
+        ])
+
+    async def test_gathers_ents_in_chunks(self):
+        keys = ['ent_7', 'missing', 'ent_2', 'ent_5', 'ent_0']
+        with patch.object(self.async_dao.dao, 'get_ents',
+                          wraps=self.async_dao.dao.get_ents) as get_ents:
+            ents = await self.async_dao.gather_ents(keys=keys, chunk_size=2)
+        self.assertEqual(list(ents), ['ent_7', 'ent_2', 'ent_5', 'ent_0'])
+        self.assertEqual(ents['ent_5']['props'], {'idx': 5, 'parity': 1})
+        self.assertEqual(get_ents.call_count, 3)
+
+    async def test_gathers_queries(self):
+        results = await self.async_dao.gather_query_ents(queries=[
+            {'prop_filters': [{'prop': 'parity', 'op': '=', 'arg': parity}]}
+            for parity in [0, 1]
+        ])
+        self.assertEqual([sorted(result) for result in results], [
+            ['ent_%s' % i for i in range(0, 10, 2)],
+            ['ent_%s' % i for i in range(1, 10, 2)],
+        ])
+
+class FileGatherTestCase(FileBaseTestCase, GatherTestCase): pass
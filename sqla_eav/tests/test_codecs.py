@@ -0,0 +1,86 @@
+import json
+import math
+import unittest
+
+from .. import codecs
+from .. import dao
+
+VALUES = [0, -7, 2 ** 70, 1.5, -0.0, 1e16, float('inf'), float('-inf'), True,
+          False, None, '', 'str', '1', {'a': [1, None, {'b': 2.5}]}, [1, 'x'],
+          {'nan': float('nan')}]
+
+class CodecRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = codecs.CodecRegistry()
+
+    def _assert_round_trips(self, registry=None):
+        for value in VALUES:
+            type_tag, raw_value = registry.encode(value=value)
+            decoded = registry.decode(raw_value=raw_value, type_tag=type_tag)
+            self.assertEqual(json.dumps(decoded), json.dumps(value))
+
+    def test_round_trips_values(self):
+        self._assert_round_trips(registry=self.registry)
+        type_tag, raw_value = self.registry.encode(value=float('nan'))
+        self.assertTrue(math.isnan(self.registry.decode(
+            raw_value=raw_value, type_tag=type_tag)))
+
+    def test_writes_legacy_rows(self):
+        for value in VALUES:
+            type_name = type(value).__name__
+            self.assertEqual(
+                self.registry.encode(value=value),
+                (type_name, value if type_name == 'str' else json.dumps(value)))
+
+    def test_reads_legacy_rows(self):
+        for value in VALUES + [float('nan')]:
+            type_name = type(value).__name__
+            raw_value = value if type_name == 'str' else json.dumps(value)
+            decoded = self.registry.decode(raw_value=raw_value,
+                                           type_tag=type_name)
+            self.assertEqual(json.dumps(decoded), json.dumps(value))
+        self.assertEqual(self.registry.decode(raw_value='x', type_tag=None),
+                         'x')
+
+    def test_writes_compact_type_tags(self):
+        registry = codecs.CodecRegistry(compact_type_tags=True)
+        self.assertEqual(registry.encode(value=1), ('i', '1'))
+        self.assertEqual(registry.encode(value={'a': 1}), ('d', '{"a": 1}'))
+        self.assertEqual(registry.get_type_name(type_tag='f'), 'float')
+        self._assert_round_trips(registry=registry)
+
+    def test_rejects_unavailable_codecs(self):
+        with self.assertRaises(Exception):
+            codecs.CodecRegistry(default_codec='some_codec')
+
+    @unittest.skipIf(codecs._orjson is None, "orjson is not installed")
+    def test_round_trips_with_orjson(self):
+        registry = codecs.CodecRegistry(default_codec='orjson')
+        self.assertEqual(registry.encode(value={'a': [1, 2]}),
+                         ('dict', '{"a":[1,2]}'))
+        self._assert_round_trips(registry=registry)
+
+    @unittest.skipIf(codecs._msgpack is None, "msgpack is not installed")
+    def test_round_trips_with_msgpack(self):
+        registry = codecs.CodecRegistry(default_codec='msgpack')
+        self.assertEqual(registry.encode(value=[1])[0], 'list:msgpack')
+        self._assert_round_trips(registry=registry)
+
+class DaoCodecTestCase(unittest.TestCase):
+    def test_reads_rows_across_codec_settings(self):
+        legacy_dao = dao.Dao(db_uri='sqlite://')
+        legacy_dao.create_tables()
+        props = {'int': 1, 'float': 2.5, 'bool': True, 'none': None,
+                 'str': 's', 'obj': {'a': [1]}}
+        legacy_dao.create_ent(ent_key='legacy', props=props)
+        compact_dao = dao.Dao(engine=legacy_dao.engine,
+                              codec_registry=codecs.CodecRegistry(
+                                  compact_type_tags=True))
+        compact_dao.create_ent(ent_key='compact', props=props)
+        for dao_ in [legacy_dao, compact_dao]:
+            ents = dao_.query_ents()
+            self.assertEqual(ents['legacy']['props'], props)
+            self.assertEqual(ents['compact']['props'], props)
+        columns = compact_dao.query_ents(format='columns')
+        self.assertEqual(columns['types']['int'], 'int')
+        self.assertEqual(list(columns['columns']['float']), [2.5, 2.5])
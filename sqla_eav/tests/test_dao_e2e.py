@@ -1,8 +1,14 @@
+import math
 import textwrap
 import time
 import unittest
+from unittest.mock import patch
 
+import sqlalchemy as _sqla
+
+from .. import blobs
 from .. import dao
+from ..utils import compression_utils
 
 class BaseTestCase(unittest.TestCase):
     def setUp(self):
@@ -11,6 +17,129 @@ class BaseTestCase(unittest.TestCase):
         self.dao.create_tables()
         self.props = {'prop_%s' % i: 'value_%s' % i for i in range(3)}
 
+class SessionTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.checked_out = []
+        _sqla.event.listen(self.dao.engine, 'checkout',
+                           lambda *args: self.checked_out.append(1))
+        _sqla.event.listen(self.dao.engine, 'checkin',
+                           lambda *args: self.checked_out.pop())
+
+    def test_releases_connections_outside_of_session(self):
+        ent = self.dao.create_ent(props=self.props)
+        self.dao.update_ent(ent_key=ent['key'], patches=self.props)
+        self.dao.query_ents()
+        self.dao.execute_sql('SELECT * FROM ents')
+        self.assertEqual(self.checked_out, [])
+
+    def test_reuses_connection_within_session(self):
+        with self.dao.session() as connection:
+            ent = self.dao.create_ent(props=self.props)
+            self.dao.update_ent(ent_key=ent['key'], patches=self.props)
+            self.dao.query_ents()
+            self.assertIs(self.dao.current_connection, connection)
+            self.assertEqual(self.checked_out, [1])
+        self.assertTrue(connection.closed)
+        self.assertIsNone(self.dao.current_connection)
+        self.assertEqual(self.checked_out, [])
+
+    def test_rolls_back_transactional_session_on_error(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.dao.session(transactional=True):
+                self.dao.create_ent(ent_key='my_ent_key', props=self.props)
+                1/0
+        self.assertEqual(self.dao.query_ents(), {})
+
+class IndexesTestCase(BaseTestCase):
+    def test_ensure_tables_ensures_indexes(self):
+        self.dao.ensure_tables()
+        self.dao.ensure_tables()
+        self.assertTrue(
+            {'ux_props_ent_key_prop', 'ix_props_prop_value'}
+            <= set(self.dao.get_index_names(table_name='props'))
+        )
+
+    def test_ensure_tables_drops_obsolete_indexes(self):
+        self.dao.execute_sql(sql='CREATE INDEX ix_props_prop ON props (prop)',
+                             rw_mode='w')
+        self.dao.ensure_tables()
+        self.assertNotIn('ix_props_prop',
+                         self.dao.get_index_names(table_name='props'))
+
+    def test_create_prop_index(self):
+        for i in range(2):
+            index_name = self.dao.create_prop_index(prop="some'prop")
+        self.assertIn(index_name, self.dao.get_index_names(table_name='props'))
+        query_plan = self.dao.execute_sql(
+            'EXPLAIN QUERY PLAN SELECT ent_key FROM props'
+            ' WHERE prop=:prop AND value=:value',
+            params={'prop': "some'prop", 'value': 'v'})
+        self.assertIn(index_name, str(query_plan))
+        self.dao.drop_prop_index(prop="some'prop")
+        self.assertNotIn(index_name,
+                         self.dao.get_index_names(table_name='props'))
+
+class EnsureTablesUpgradeTestCase(unittest.TestCase):
+    def setUp(self):
+        # Tables as created by the original schema, with no typed values.
+        self.dao = dao.Dao(db_uri='sqlite://')
+        for sql in [
+            'CREATE TABLE ents (key VARCHAR(255) PRIMARY KEY,'
+            ' created INTEGER, modified INTEGER)',
+            'CREATE TABLE props (key VARCHAR(255) PRIMARY KEY,'
+            ' ent_key VARCHAR(255) REFERENCES ents (key),'
+            ' prop VARCHAR(1024), value TEXT, type VARCHAR(16),'
+            ' modified INTEGER)',
+            'CREATE INDEX ix_props_ent_key ON props (ent_key)',
+            'CREATE INDEX ix_props_prop ON props (prop)',
+        ]: self.dao.execute_sql(sql=sql, rw_mode='w')
+        for i, (value, type_) in enumerate([
+            ('1', 'int'), ('9007199254740993', 'int'), ('2.5', 'float'),
+            ('true', 'bool'), ('1', 'str'),
+        ]):
+            self.dao.execute_sql(
+                sql='INSERT INTO ents VALUES (:key, 0, 0)',
+                params={'key': 'ent_%s' % i}, rw_mode='w')
+            self.dao.execute_sql(
+                sql="INSERT INTO props VALUES (:key, :key, 'x', :value,"
+                " :type, 0)",
+                params={'key': 'ent_%s' % i, 'value': value, 'type': type_},
+                rw_mode='w')
+        self.dao.ensure_tables()
+
+    def _query_keys(self, *prop_filters):
+        return sorted(self.dao.query_ents(query={
+            'prop_filters': list(prop_filters)}).keys())
+
+    def test_adds_missing_columns(self):
+        column_names = {
+            column['name'] for column in
+            _sqla.inspect(self.dao.engine).get_columns('props')}
+        self.assertTrue({'value_int', 'value_float', 'value_bool', 'blob_key',
+                         'value_size', 'value_encoding'} <= column_names)
+        index_names = self.dao.get_index_names(table_name='props')
+        self.assertIn('ix_props_prop_value_int', index_names)
+        self.assertFalse({'ix_props_ent_key', 'ix_props_prop'}
+                         & set(index_names))
+
+    def test_backfills_typed_values(self):
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '=', 'arg': 1}), ['ent_0'])
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '=',
+                              'arg': 9007199254740993}), ['ent_1'])
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '<', 'arg': 3.0}),
+            ['ent_0', 'ent_2'])
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '=', 'arg': True}), ['ent_3'])
+        self.assertEqual(self.dao.get_ent(key='ent_1')['props'],
+                         {'x': 9007199254740993})
+
+    def test_upgrades_idempotently(self):
+        self.assertEqual(self.dao.ensure_columns(), {})
+
 class CreateEntTestCase(BaseTestCase):
     def test_create_ent(self):
         ent = self.dao.create_ent(props=self.props)
@@ -21,6 +150,64 @@ class CreateEntTestCase(BaseTestCase):
         })
         self.assertEqual(fetched_ents[ent['key']], ent)
 
+class CreateEntsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ents = [{'props': {'idx': i, **self.props}} for i in range(5)]
+        self.ents.append({'key': 'my_ent_key', 'props': self.props})
+        self.ents.append({'key': 'ent_sans_props'})
+
+    def test_create_ents(self):
+        ent_keys = self.dao.create_ents(ents=self.ents, batch_size=2)
+        self.assertEqual(len(ent_keys), len(self.ents))
+        self.assertEqual(ent_keys[-2:], ['my_ent_key', 'ent_sans_props'])
+        fetched_ents = self.dao.query_ents()
+        self.assertEqual(
+            [fetched_ents[ent_key]['props'] for ent_key in ent_keys[:-1]],
+            [ent['props'] for ent in self.ents[:-1]]
+        )
+        self.assertIn('ent_sans_props', fetched_ents)
+
+    def test_returns_ents_if_return_ents(self):
+        created_ents = self.dao.create_ents(ents=self.ents, batch_size=2,
+                                            return_ents=True)
+        self.assertEqual(created_ents, self.dao.query_ents())
+
+class GetEntsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ents = self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i, 'props': {'idx': i, **self.props}}
+            for i in range(5)
+        ] + [{'key': 'ent_sans_props'}], return_ents=True)
+
+    def test_get_ents(self):
+        keys = ['ent_3', 'missing', 'ent_1', 'ent_sans_props', 'ent_3']
+        actual = self.dao.get_ents(keys=keys)
+        self.assertEqual(list(actual.keys()),
+                         ['ent_3', 'ent_1', 'ent_sans_props'])
+        self.assertEqual(actual, {key: self.ents[key] for key in actual})
+        self.assertEqual(actual['ent_sans_props']['props'], {})
+        self.assertEqual(actual, {key: ent for key, ent in
+                                  self.dao.query_ents().items()
+                                  if key in actual})
+
+    def test_limits_props(self):
+        actual = self.dao.get_ents(keys=['ent_1', 'ent_2'],
+                                   props=['idx', 'missing'])
+        self.assertEqual({key: ent['props'] for key, ent in actual.items()},
+                         {'ent_1': {'idx': 1}, 'ent_2': {'idx': 2}})
+
+    def test_chunks_keys(self):
+        self.dao.MAX_BIND_PARAMS = {'sqlite': 2}
+        actual = self.dao.get_ents(keys=['ent_%s' % i for i in range(5)])
+        self.assertEqual(actual, {'ent_%s' % i: self.ents['ent_%s' % i]
+                                  for i in range(5)})
+
+    def test_get_ent(self):
+        self.assertEqual(self.dao.get_ent(key='ent_0'), self.ents['ent_0'])
+        self.assertIsNone(self.dao.get_ent(key='missing'))
+
 class PatchEntTestCase(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -63,6 +250,57 @@ class PatchEntTestCase(BaseTestCase):
         self.dao.update_ent(ent_key=self.ent['key'], patches=patches_2)
         self.assert_patches(patches=patches_2)
 
+class DiffUpdateEntTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ent = self.dao.create_ent(props=self.props)
+        self.initial_prop_rows = self.get_prop_rows()
+
+    def get_prop_rows(self):
+        return {
+            row['prop']: row for row in self.dao.execute_sql(
+                'SELECT key, prop, value FROM props WHERE ent_key=:ent_key',
+                params={'ent_key': self.ent['key']})
+        }
+
+    def get_ent_modified(self):
+        return self.dao.execute_sql(
+            'SELECT modified FROM ents WHERE key=:ent_key',
+            params={'ent_key': self.ent['key']})[0]['modified']
+
+    def test_skips_unchanged_props(self):
+        time.sleep(.002)
+        self.dao.update_ent(ent_key=self.ent['key'], patches=self.props,
+                            ent_modified=self.ent['modified'], diff=True)
+        self.assertEqual(self.get_prop_rows(), self.initial_prop_rows)
+        self.assertEqual(self.get_ent_modified(), self.ent['modified'])
+
+    def test_only_rewrites_changed_props(self):
+        time.sleep(.002)
+        self.dao.update_ent(ent_key=self.ent['key'],
+                            patches={'prop_0': 'new_value', 'prop_1': 'value_1',
+                                     'new_prop': 'value'},
+                            deletions=['prop_2'], diff=True)
+        prop_rows = self.get_prop_rows()
+        self.assertEqual(
+            {prop: row['value'] for prop, row in prop_rows.items()},
+            {'prop_0': 'new_value', 'prop_1': 'value_1', 'new_prop': 'value'}
+        )
+        for prop in ['prop_0', 'prop_1']:
+            self.assertEqual(prop_rows[prop]['key'],
+                             self.initial_prop_rows[prop]['key'])
+        self.assertGreater(self.get_ent_modified(), self.ent['modified'])
+
+    def test_validates_modified_if_given(self):
+        time.sleep(.002)
+        self.dao.update_ent(ent_key=self.ent['key'],
+                            patches={'prop_0': 'new_value'}, diff=True)
+        for patches in [{'prop_0': 'new_value'}, {'prop_0': 'newer_value'}]:
+            with self.assertRaises(self.dao.StaleEntError):
+                self.dao.update_ent(ent_key=self.ent['key'], patches=patches,
+                                    ent_modified=self.ent['modified'],
+                                    diff=True)
+
 class QueryPropsTestCase(BaseTestCase):
     def test_prop_existence_query(self):
         self.dao.create_ent(props=self.props)
@@ -172,6 +410,725 @@ class QueryEntsTestCase(BaseTestCase):
         }
         self.assertEqual(actual, expected)
 
+class QueryEntsPropFilterStrategiesTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i,
+             'props': {'idx': i, 'parity': i % 2, 'name': 'name_%s' % i}}
+            for i in range(10)
+        ])
+        self.queries = [
+            {'prop_filters': [{'prop': 'idx', 'op': '>', 'arg': 2},
+                              {'prop': 'parity', 'op': '! =', 'arg': 1}]},
+            {'prop_filters': [{'prop': 'name', 'op': 'LIKE', 'arg': '%1%'},
+                              {'prop': 'idx', 'op': 'EXISTS'}]},
+            {'prop_filters': [{'prop': 'idx', 'op': '<', 'arg': 8}],
+             'order_by': [{'prop': 'idx', 'type': 'int', 'desc': True}],
+             'limit': 3},
+        ]
+
+    def test_strategies_return_same_ents(self):
+        results_by_strategy = {
+            strategy: [
+                self.dao.query_ents(query={**query,
+                                           'prop_filter_strategy': strategy})
+                for query in self.queries
+            ]
+            for strategy in self.dao.PROP_FILTER_STRATEGIES
+        }
+        self.assertEqual(sorted(results_by_strategy['exists'][0]),
+                         ['ent_4', 'ent_6', 'ent_8'])
+        self.assertEqual(sorted(results_by_strategy['exists'][1]), ['ent_1'])
+        self.assertEqual(list(results_by_strategy['exists'][2]),
+                         ['ent_7', 'ent_6', 'ent_5'])
+        for strategy in ['join', 'in_subquery']:
+            self.assertEqual(results_by_strategy[strategy],
+                             results_by_strategy['exists'])
+
+    def test_uses_dao_strategy(self):
+        self.assertEqual(self.dao.prop_filter_strategy, 'in_subquery')
+        self.dao.prop_filter_strategy = 'exists'
+        statement = self.dao.get_ents_query_statement(query=self.queries[0])
+        self.assertIn('EXISTS (SELECT', str(statement))
+
+class QueryEntsFilterTreesTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ents = self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i,
+             'props': {'idx': i, 'color': ['red', 'green', 'blue'][i % 3],
+                       **({'tag': 'tagged'} if i % 4 == 0 else {})}}
+            for i in range(12)
+        ], return_ents=True)
+
+    def _query_keys(self, query=None):
+        return sorted(self.dao.query_ents(query=query).keys(),
+                      key=lambda key: int(key.split('_')[1]))
+
+    def test_ors_filters(self):
+        self.assertEqual(self._query_keys(query={'prop_filters': [
+            {'or': [{'prop': 'idx', 'op': '<', 'arg': 2},
+                    {'prop': 'color', 'op': '=', 'arg': 'blue'}]}
+        ]}), ['ent_0', 'ent_1', 'ent_2', 'ent_5', 'ent_8', 'ent_11'])
+
+    def test_nests_and_not_groups(self):
+        self.assertEqual(self._query_keys(query={'prop_filters': [
+            {'prop': 'idx', 'op': '>=', 'arg': 3},
+            {'or': [
+                {'and': [{'prop': 'color', 'op': '=', 'arg': 'red'},
+                         {'not': {'prop': 'tag', 'op': 'EXISTS'}}]},
+                {'not': {'prop': 'idx', 'op': '<', 'arg': 10}},
+            ]}
+        ]}), ['ent_3', 'ent_6', 'ent_9', 'ent_10', 'ent_11'])
+
+    def test_groups_match_flat_filters(self):
+        self.dao.create_ent(ent_key='ent_sans_props', props={})
+        for filter_ in [{'prop': 'tag', 'op': '! EXISTS'},
+                        {'prop': 'idx', 'op': '!=', 'arg': 3}]:
+            flat_query = {'prop_filters': [filter_]}
+            grouped_query = {'prop_filters': [{'and': [filter_]}]}
+            self.assertEqual(
+                sorted(self.dao.query_ents(query=grouped_query).keys()),
+                sorted(self.dao.query_ents(query=flat_query).keys()))
+            self.assertNotIn('ent_sans_props',
+                             self.dao.query_ents(query=grouped_query))
+            self.assertEqual(self.dao.count_ents(query=grouped_query),
+                             self.dao.count_ents(query=flat_query))
+
+    def test_handles_in_ops(self):
+        self.assertEqual(self._query_keys(query={'prop_filters': [
+            {'prop': 'color', 'op': 'IN', 'arg': ['red', 'blue']},
+            {'prop': 'idx', 'op': 'NOT IN', 'arg': [0, 2, 3, 4]},
+        ]}), ['ent_5', 'ent_6', 'ent_8', 'ent_9', 'ent_11'])
+        self.assertEqual(self._query_keys(query={'prop_filters': [
+            {'prop': 'idx', 'op': 'in', 'arg': [1, 7]},
+        ]}), ['ent_1', 'ent_7'])
+
+    def test_reuses_statements_across_in_list_lengths(self):
+        cached_statement_count = len(self.dao.statement_cache)
+        for arg in [[1], [1, 2, 3]]:
+            self.assertEqual(
+                self._query_keys(query={'prop_filters': [
+                    {'prop': 'idx', 'op': 'IN', 'arg': arg}]}),
+                ['ent_%s' % i for i in arg])
+        self.assertEqual(len(self.dao.statement_cache),
+                         cached_statement_count + 1)
+
+    def test_combines_prop_and_ent_filters_in_trees(self):
+        self.assertEqual(self._query_keys(query={'ent_filters': [
+            {'or': [{'col': 'key', 'op': '=', 'arg': 'ent_1'},
+                    {'prop': 'tag', 'op': 'EXISTS'}]}
+        ]}), ['ent_0', 'ent_1', 'ent_4', 'ent_8'])
+
+    def test_pages_filter_trees(self):
+        page = self.dao.query_ents_page(query={
+            'prop_filters': [{'or': [{'prop': 'color', 'op': '=',
+                                      'arg': 'green'},
+                                     {'prop': 'tag', 'op': 'EXISTS'}]}],
+            'order_by': [{'prop': 'idx', 'type': 'int', 'desc': True}],
+            'limit': 3,
+        })
+        self.assertEqual(list(page['ents']), ['ent_10', 'ent_8', 'ent_7'])
+
+class QueryEntsStatementCacheTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            self.dao.create_ent(ent_key='ent_%s' % i, props={'idx': i})
+
+    def test_reuses_statements_across_args(self):
+        self.dao.statement_cache = dao.LRUCache(max_size=10)
+        self.dao.compiled_cache = dao.LRUCache(max_size=10)
+        for i in range(3):
+            actual = self.dao.query_ents(query={
+                'prop_filters': [{'prop': 'idx', 'op': '<=', 'arg': i}],
+                'ent_filters': [{'col': 'key', 'op': '! =',
+                                 'arg': 'ent_%s' % i}],
+            })
+            self.assertEqual(sorted(actual.keys()),
+                             ['ent_%s' % j for j in range(i)])
+        self.assertEqual(self.dao.statement_cache.get_stats()['misses'], 1)
+        self.assertEqual(self.dao.statement_cache.get_stats()['hits'], 2)
+        self.assertEqual(len(self.dao.compiled_cache), 1)
+
+class QueryEntsTypedValuesTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.values = [9, 10, 2.5, True, '10', None]
+        self.ents = {
+            'ent_%s' % i: self.dao.create_ent(ent_key='ent_%s' % i,
+                                              props={'x': value})
+            for i, value in enumerate(self.values)
+        }
+
+    def _query_keys(self, *prop_filters):
+        return sorted(self.dao.query_ents(query={
+            'prop_filters': list(prop_filters)}).keys())
+
+    def test_compares_numbers_numerically(self):
+        self.assertEqual(self._query_keys({'prop': 'x', 'op': '<', 'arg': 10}),
+                         ['ent_0', 'ent_2'])
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '>=', 'arg': 9.5}),
+            ['ent_1'])
+
+    def test_compares_large_ints_exactly(self):
+        self.dao.create_ent(ent_key='ent_big', props={'x': 2 ** 53})
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '=', 'arg': 2 ** 53 + 1}), [])
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '>', 'arg': 2 ** 53 - 1}),
+            ['ent_big'])
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': 'IN',
+                              'arg': [2 ** 53, 2 ** 53 + 1]}),
+            ['ent_big'])
+
+    def test_orders_large_ints_exactly(self):
+        for i, value in enumerate([2 ** 53 + 1, 2 ** 53]):
+            self.dao.create_ent(ent_key='ent_big_%s' % i, props={'y': value})
+        ents = self.dao.query_ents(query={
+            'order_by': [{'prop': 'y', 'type': 'int'}], 'limit': 2})
+        self.assertEqual(list(ents.keys()), ['ent_big_1', 'ent_big_0'])
+
+    def test_compares_int_args_to_floats(self):
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '!=', 'arg': 9}),
+            ['ent_1', 'ent_2'])
+
+    def test_compares_bools(self):
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '=', 'arg': True}),
+            ['ent_3'])
+
+    def test_compares_strings_as_text(self):
+        self.assertEqual(
+            self._query_keys({'prop': 'x', 'op': '=', 'arg': '10'}),
+            ['ent_1', 'ent_4'])
+
+class QueryEntsColumnsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ents = self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i,
+             'props': {'int': i, 'float': i / 2, 'bool': (i % 2 == 0),
+                       'str': 's%s' % i, 'obj': {'i': i},
+                       'mixed': [i, str(i)][i % 2],
+                       **({'sparse': i} if i % 2 else {})}}
+            for i in range(4)
+        ], return_ents=True)
+        self.columns = self.dao.query_ents(query={
+            'order_by': [{'prop': 'int', 'type': 'int'}]
+        }, format='columns')
+
+    def test_returns_ent_keys(self):
+        self.assertEqual(self.columns['ent_keys'],
+                         ['ent_%s' % i for i in range(4)])
+
+    def test_returns_numeric_arrays(self):
+        self.assertEqual(self.columns['types']['int'], 'int')
+        self.assertEqual(list(self.columns['columns']['int']), [0, 1, 2, 3])
+        self.assertEqual(self.columns['types']['float'], 'float')
+        self.assertEqual(list(self.columns['columns']['float']),
+                         [0.0, 0.5, 1.0, 1.5])
+        self.assertNotIsInstance(self.columns['columns']['int'], list)
+
+    def test_pads_sparse_numeric_columns_with_nan(self):
+        self.assertEqual(self.columns['types']['sparse'], 'float')
+        sparse = list(self.columns['columns']['sparse'])
+        self.assertTrue(math.isnan(sparse[0]) and math.isnan(sparse[2]))
+        self.assertEqual([sparse[1], sparse[3]], [1.0, 3.0])
+
+    def test_returns_other_types_as_lists(self):
+        self.assertEqual(list(self.columns['columns']['bool']),
+                         [True, False, True, False])
+        self.assertEqual(self.columns['columns']['str'],
+                         ['s0', 's1', 's2', 's3'])
+        self.assertEqual(self.columns['columns']['obj'],
+                         [{'i': i} for i in range(4)])
+        self.assertEqual(self.columns['types']['mixed'], 'object')
+        self.assertEqual(self.columns['columns']['mixed'], [0, '1', 2, '3'])
+
+    def test_places_values_by_ent_when_rows_interleave(self):
+        prepared_query = self.dao.prepare_ents_query(query={
+            'typed_values': True, 'props_to_select': ['int', 'bool'],
+            'ent_filters': [{'col': 'key', 'op': 'IN',
+                             'arg': ['ent_0', 'ent_1']}]
+        })
+        result_proxy = self.dao.execute_prepared_query(
+            prepared_query=prepared_query)
+        column_names = list(result_proxy.keys())
+        rows = {(row['ent_key'], row['prop']): row
+                for row in result_proxy.fetchall()}
+
+        class InterleavedResult(list):
+            def keys(self): return column_names
+
+        columns = self.dao.result_proxy_to_ent_columns(
+            result_proxy=InterleavedResult([
+                rows[('ent_0', 'bool')], rows[('ent_1', 'int')],
+                rows[('ent_1', 'bool')], rows[('ent_0', 'int')],
+            ]))
+        self.assertEqual(columns['ent_keys'], ['ent_0', 'ent_1'])
+        self.assertEqual(list(columns['columns']['int']), [0, 1])
+        self.assertEqual(list(columns['columns']['bool']), [True, False])
+
+    def test_includes_selected_props_sans_values(self):
+        columns = self.dao.query_ents(query={'props_to_select': ['int', 'nope']},
+                                      format='columns')
+        self.assertEqual(sorted(columns['columns']), ['int', 'nope'])
+        self.assertEqual(columns['columns']['nope'], [None] * 4)
+
+class AggregateTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i,
+             'props': {'idx': i, 'color': ['red', 'blue'][i % 2],
+                       **({'size': i / 2} if i < 4 else {})}}
+            for i in range(6)
+        ])
+        self.dao.create_ent(ent_key='ent_sans_props', props={})
+
+    def test_counts_ents(self):
+        self.assertEqual(self.dao.count_ents(), 7)
+        self.assertEqual(self.dao.count_ents(query={
+            'prop_filters': [{'prop': 'idx', 'op': '>=', 'arg': 2}],
+            'limit': 1,
+        }), 4)
+        self.assertEqual(self.dao.count_ents(query={
+            'prop_filters': [{'prop': 'color', 'op': '=', 'arg': 'red'},
+                             {'prop': 'size', 'op': 'EXISTS'}]
+        }), 2)
+
+    def test_aggregates_without_group_by(self):
+        self.assertEqual(
+            self.dao.aggregate(query={
+                'prop_filters': [{'prop': 'idx', 'op': 'EXISTS'}]
+            }, metrics=[{'op': 'count'}, {'op': 'sum', 'prop': 'idx'},
+                        {'op': 'max', 'prop': 'size', 'label': 'biggest'}]),
+            [{'group_by': {},
+              'metrics': {'count': 6, 'sum_idx': 15.0, 'biggest': 1.5}}]
+        )
+
+    def test_aggregates_ints_exactly(self):
+        self.dao.create_ent(ent_key='ent_big', props={'idx': 2 ** 53 + 1})
+        results = self.dao.aggregate(metrics=[
+            {'op': 'max', 'prop': 'idx', 'type': 'int'},
+            {'op': 'min', 'prop': 'idx', 'type': 'int'},
+            {'op': 'sum', 'prop': 'idx', 'type': 'int', 'label': 'total'},
+        ])
+        self.assertEqual(results[0]['metrics'], {
+            'max_idx': 2 ** 53 + 1, 'min_idx': 0, 'total': 2 ** 53 + 16})
+        self.assertIsInstance(results[0]['metrics']['min_idx'], int)
+
+    def test_rejects_propless_metrics_other_than_count(self):
+        with self.assertRaises(Exception):
+            self.dao.aggregate(metrics=[{'op': 'sum'}])
+
+    def test_aggregates_by_group(self):
+        results = self.dao.aggregate(
+            group_by=['color'],
+            metrics=[{'op': 'count'}, {'op': 'avg', 'prop': 'idx'},
+                     {'op': 'count', 'prop': 'size'}])
+        self.assertEqual(
+            sorted(results, key=lambda result: str(result['group_by'])),
+            [
+                {'group_by': {'color': 'blue'},
+                 'metrics': {'count': 3, 'avg_idx': 3.0, 'count_size': 2}},
+                {'group_by': {'color': 'red'},
+                 'metrics': {'count': 3, 'avg_idx': 2.0, 'count_size': 2}},
+                {'group_by': {'color': None},
+                 'metrics': {'count': 1, 'avg_idx': None, 'count_size': 0}},
+            ]
+        )
+
+class BlobsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dao.blob_threshold = 100
+        self.doc = {'text': 'x' * 500, 'items': list(range(50))}
+        self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i, 'props': {'doc': self.doc, 'idx': i}}
+            for i in range(3)
+        ])
+
+    def _get_props_rows(self):
+        props_table = self.dao.schema['tables']['props']
+        return {
+            (row['ent_key'], row['prop']): row for row in self.dao.execute(
+                props_table.select()).fetchall()
+        }
+
+    def _count_blobs(self):
+        return self.dao.execute(_sqla.select([_sqla.func.count()]).select_from(
+            self.dao.schema['tables']['blobs'])).scalar()
+
+    def test_offloads_large_values(self):
+        rows = self._get_props_rows()
+        self.assertIsNone(rows[('ent_0', 'doc')]['value'])
+        self.assertIsNotNone(rows[('ent_0', 'doc')]['blob_key'])
+        self.assertGreater(rows[('ent_0', 'doc')]['value_size'], 100)
+        self.assertEqual(rows[('ent_0', 'idx')]['value'], '0')
+        self.assertIsNone(rows[('ent_0', 'idx')]['blob_key'])
+        self.assertEqual(self._count_blobs(), 1)
+
+    def test_returns_lazy_values(self):
+        ents = self.dao.query_ents()
+        doc = ents['ent_0']['props']['doc']
+        self.assertIsInstance(doc, blobs.LazyBlobValue)
+        self.assertFalse(doc.loaded)
+        self.assertEqual(doc.value, self.doc)
+        self.assertEqual(ents['ent_0']['props']['idx'], 0)
+        self.assertEqual(self.dao.get_ent(key='ent_1')['props']['doc'].value,
+                         self.doc)
+
+    def test_aggregates_by_offloaded_values(self):
+        self.dao.create_ent(ent_key='ent_other',
+                            props={'doc': {**self.doc, 'text': 'y' * 500}})
+        results = self.dao.aggregate(group_by=['doc'])
+        self.assertEqual(
+            sorted([(result['group_by']['doc']['text'][0],
+                     result['metrics']['count']) for result in results]),
+            [('x', 3), ('y', 1)]
+        )
+
+    def test_loads_blobs_in_batch(self):
+        with patch.object(self.dao, 'load_blob_raw_values',
+                          wraps=self.dao.load_blob_raw_values) as load:
+            ents = self.dao.query_ents(query={'load_blobs': True})
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual([ent['props']['doc'] for ent in ents.values()],
+                         [self.doc] * 3)
+        page = self.dao.query_ents_page(query={
+            'limit': 1, 'props_to_select': ['doc'], 'load_blobs': True,
+            'pivot': True})
+        self.assertEqual(list(page['ents'].values())[0]['props'],
+                         {'doc': self.doc})
+
+    def test_reads_columns(self):
+        columns = self.dao.query_ents(query={'props_to_select': ['doc']},
+                                      format='columns')
+        self.assertEqual(columns['columns']['doc'], [self.doc] * 3)
+
+    def test_updates_offloaded_values(self):
+        new_doc = {**self.doc, 'text': 'y' * 500}
+        self.dao.update_ent(ent_key='ent_0', patches={'doc': new_doc},
+                            diff=True)
+        self.dao.upsert_ent(ent_key='ent_1', patches={'doc': 'small'})
+        ents = self.dao.query_ents(query={'load_blobs': True})
+        self.assertEqual(
+            [ents['ent_%s' % i]['props']['doc'] for i in range(3)],
+            [new_doc, 'small', self.doc])
+        self.assertEqual(self._count_blobs(), 2)
+        self.dao.delete_props(ent_key='ent_2', props_to_delete=['doc'])
+        self.assertEqual(self.dao.delete_orphaned_blobs(), 1)
+        self.assertEqual(self._count_blobs(), 1)
+
+class ValueCompressionTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dao.value_compression = 'zlib'
+        self.dao.value_compression_threshold = 64
+        self.docs = [[{'name': 'item_%s' % j, 'tags': ['a', 'b']}
+                      for j in range(i + 5)] for i in range(3)]
+        self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i,
+             'props': {'doc': doc, 'idx': i, 'group': 'g' * 100}}
+            for i, doc in enumerate(self.docs)
+        ])
+
+    def _get_props_rows(self):
+        props_table = self.dao.schema['tables']['props']
+        return {
+            (row['ent_key'], row['prop']): row for row in self.dao.execute(
+                props_table.select()).fetchall()
+        }
+
+    def test_compresses_large_values(self):
+        rows = self._get_props_rows()
+        doc_row = rows[('ent_0', 'doc')]
+        self.assertEqual(doc_row['value_encoding'], 'zlib')
+        self.assertLess(len(doc_row['value']), doc_row['value_size'])
+        self.assertIsNone(rows[('ent_0', 'idx')]['value_encoding'])
+
+    def test_keeps_incompressible_values_plain(self):
+        value = ''.join(chr(33 + (i * 7919) % 90) for i in range(100))
+        self.dao.create_ent(ent_key='random', props={'value': value})
+        self.assertIsNone(
+            self._get_props_rows()[('random', 'value')]['value_encoding'])
+
+    def test_reads_compressed_values(self):
+        expected = {'ent_%s' % i: {'doc': doc, 'idx': i, 'group': 'g' * 100}
+                    for i, doc in enumerate(self.docs)}
+        plain_dao = dao.Dao(engine=self.dao.engine)
+        for dao_ in [self.dao, plain_dao]:
+            ents = dao_.query_ents()
+            self.assertEqual({key: ent['props'] for key, ent in ents.items()},
+                             expected)
+            self.assertEqual(dao_.get_ent(key='ent_1')['props'],
+                             expected['ent_1'])
+        pivoted = self.dao.query_ents(query={'props_to_select': ['doc'],
+                                             'pivot': True})
+        self.assertEqual(pivoted['ent_2']['props'], {'doc': self.docs[2]})
+        columns = self.dao.query_ents(format='columns', query={
+            'order_by': [{'prop': 'idx', 'type': 'int'}]})
+        self.assertEqual(columns['columns']['doc'], self.docs)
+        self.assertEqual(
+            self.dao.aggregate(group_by=['group']),
+            [{'group_by': {'group': 'g' * 100}, 'metrics': {'count': 3}}])
+
+    def test_diffs_compressed_values(self):
+        self.dao.update_ent(ent_key='ent_0', patches={'doc': self.docs[0]},
+                            diff=True)
+        prop_diff = self.dao.get_prop_diff(
+            ent_key='ent_0', patches={'doc': self.docs[0], 'idx': 0})
+        self.assertFalse(any(prop_diff.values()))
+
+@unittest.skipIf(compression_utils._zstd is None,
+                 "zstandard is not installed")
+class ValueCompressionDictTestCase(BaseTestCase):
+    def test_compresses_with_trained_dict(self):
+        docs = [{'id': i, 'name': 'item_%s' % i, 'kind': ['a', 'b'][i % 2],
+                 'labels': ['label_%s' % (i % 7), 'shared']}
+                for i in range(500)]
+        self.dao.create_ents(ents=[{'key': 'ent_%s' % i, 'props': {'doc': doc}}
+                                   for i, doc in enumerate(docs)])
+        self.dao.value_compression = 'zstd'
+        self.dao.value_compression_threshold = 32
+        dict_key = self.dao.train_value_compression_dict(dict_size=4096)
+        self.dao.upsert_ents(ents=[
+            {'key': 'ent_%s' % i, 'patches': {'doc': doc}}
+            for i, doc in enumerate(docs)
+        ])
+        props_table = self.dao.schema['tables']['props']
+        self.assertEqual(
+            {row['value_encoding'] for row in self.dao.execute(
+                _sqla.select([props_table.c.value_encoding])).fetchall()},
+            {'zstd:%s' % dict_key})
+        fresh_dao = dao.Dao(engine=self.dao.engine)
+        self.assertEqual(fresh_dao.load_value_compression_dict(), dict_key)
+        self.assertEqual(
+            [ent['props']['doc'] for ent in
+             fresh_dao.get_ents(keys=['ent_%s' % i for i in range(500)])
+             .values()],
+            docs)
+
+class ChangesSinceTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dao.track_deletions = True
+        self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i, 'props': {'idx': i}} for i in range(5)])
+        # ent_3 and ent_1 share a modified time, so key breaks the tie.
+        self.modifieds = {'ent_0': 100, 'ent_1': 300, 'ent_2': 200,
+                          'ent_3': 300, 'ent_4': 400}
+        ents = self.dao.schema['tables']['ents']
+        for ent_key, modified in self.modifieds.items():
+            self.dao.execute(ents.update().where(ents.c.key == ent_key)
+                             .values(modified=modified))
+
+    def _summarize(self, changes=None):
+        return [(change['key'], change['modified'], change['deleted'])
+                for change in changes]
+
+    def test_indexes_modified(self):
+        self.assertIn('ix_ents_modified_key',
+                      self.dao.get_index_names(table_name='ents'))
+
+    def test_pages_changes_in_modified_order(self):
+        page = self.dao.changes_since(ts=200, limit=2)
+        self.assertEqual(self._summarize(page['changes']),
+                         [('ent_2', 200, False), ('ent_1', 300, False)])
+        self.assertEqual(page['changes'][0]['ent']['props'], {'idx': 2})
+        self.assertTrue(page['has_more'])
+        page = self.dao.changes_since(ts=200, limit=2, cursor=page['cursor'])
+        self.assertEqual(self._summarize(page['changes']),
+                         [('ent_3', 300, False), ('ent_4', 400, False)])
+        page = self.dao.changes_since(ts=200, limit=2, cursor=page['cursor'])
+        self.assertEqual(page['changes'], [])
+        self.assertFalse(page['has_more'])
+        self.assertIsNotNone(page['cursor'])
+
+    def test_resumes_with_later_changes_and_tombstones(self):
+        cursor = self.dao.changes_since(ts=0)['cursor']
+        self.dao.update_ent(ent_key='ent_0', patches={'idx': 10})
+        self.assertEqual(self.dao.delete_ent(ent_key='ent_2'), ['ent_2'])
+        self.assertEqual(self.dao.delete_ent(ent_key='missing'), [])
+        changes = list(self.dao.iter_changes_since(cursor=cursor,
+                                                   batch_size=1))
+        self.assertEqual([(change['key'], change['deleted'])
+                          for change in changes],
+                         [('ent_0', False), ('ent_2', True)])
+        self.assertEqual(changes[0]['ent']['props'], {'idx': 10})
+        self.assertIsNone(changes[1]['ent'])
+        self.assertIsNone(self.dao.get_ent(key='ent_2'))
+
+    def test_deletes_without_tombstones(self):
+        self.dao.track_deletions = False
+        self.dao.delete_ents(ent_keys=['ent_0', 'ent_1'])
+        self.assertEqual(
+            [change['key'] for change in
+             self.dao.iter_changes_since(ts=0, batch_size=2)],
+            ['ent_2', 'ent_3', 'ent_4'])
+        self.assertEqual(self.dao.execute_sql(
+            sql='SELECT COUNT(*) AS count FROM props'), [{'count': 3}])
+
+    def test_prunes_tombstones(self):
+        self.dao.delete_ents(ent_keys=['ent_0', 'ent_1'])
+        self.assertEqual(self.dao.prune_tombstones(before=0), 0)
+        self.assertEqual(self.dao.prune_tombstones(before=2 ** 62), 2)
+
+class QueryEntsPageTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.idxs = [3, 10, 1, 7, 7, 2, 9]
+        self.ents = {
+            'ent_%s' % i: self.dao.create_ent(
+                ent_key='ent_%s' % i,
+                props={'idx': idx, 'parity': idx % 2, **self.props})
+            for i, idx in enumerate(self.idxs)
+        }
+
+    def _query_all_pages(self, query=None):
+        pages = []
+        cursor = None
+        while True:
+            page = self.dao.query_ents_page(query={**query, 'cursor': cursor})
+            pages.append(list(page['ents'].keys()))
+            cursor = page['cursor']
+            if cursor is None: return pages
+
+    def test_pages_by_ent_key(self):
+        pages = self._query_all_pages(query={'limit': 3})
+        self.assertEqual(pages, [['ent_0', 'ent_1', 'ent_2'],
+                                 ['ent_3', 'ent_4', 'ent_5'],
+                                 ['ent_6']])
+
+    def test_pages_by_prop(self):
+        pages = self._query_all_pages(query={
+            'limit': 2,
+            'order_by': [{'prop': 'idx', 'type': 'int', 'desc': True}],
+            'prop_filters': [{'prop': 'parity', 'op': '=', 'arg': 1}],
+        })
+        self.assertEqual(pages, [['ent_6', 'ent_3'], ['ent_4', 'ent_0'],
+                                 ['ent_2']])
+
+    def test_pages_ents_sans_sort_prop_last(self):
+        for ent_key in ['ent_x', 'ent_y']:
+            self.dao.create_ent(ent_key=ent_key, props={'parity': 1})
+        for desc, ent_keys in [
+            (False, ['ent_2', 'ent_0', 'ent_3', 'ent_4', 'ent_6']),
+            (True, ['ent_6', 'ent_3', 'ent_4', 'ent_0', 'ent_2']),
+        ]:
+            pages = self._query_all_pages(query={
+                'limit': 2,
+                'order_by': [{'prop': 'idx', 'type': 'int', 'desc': desc}],
+                'prop_filters': [{'prop': 'parity', 'op': '=', 'arg': 1}],
+            })
+            self.assertEqual(pages, [ent_keys[:2], ent_keys[2:4],
+                                     [ent_keys[4], 'ent_x'], ['ent_y']])
+
+    def test_pages_by_ent_col(self):
+        page = self.dao.query_ents_page(query={
+            'limit': 3,
+            'order_by': [{'col': 'created', 'desc': True}],
+        })
+        self.assertEqual(len(page['ents']), 3)
+        self.assertEqual(page['ents'], {ent_key: self.ents[ent_key]
+                                        for ent_key in page['ents']})
+        self.assertIsNotNone(page['cursor'])
+
+    def test_query_ents_honors_limit(self):
+        ents = self.dao.query_ents(query={
+            'limit': 4, 'order_by': [{'prop': 'idx', 'type': 'int'}]})
+        self.assertEqual(list(ents.keys()),
+                         ['ent_2', 'ent_5', 'ent_0', 'ent_3'])
+
+class PivotQueryEntsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ents = self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i,
+             'props': {'idx': i, 'even': (i % 2 == 0), 'nothing': None,
+                       'obj': {'i': [i]}, **self.props}}
+            for i in range(5)
+        ] + [{'key': 'ent_sans_idx', 'props': {'prop_0': 'x'}}],
+            return_ents=True)
+        self.props_to_select = ['idx', 'even', 'nothing', 'obj', 'prop_0']
+
+    def _assert_matches_unpivoted(self, query=None):
+        query = {**query, 'props_to_select': self.props_to_select}
+        pivoted = self.dao.query_ents(query={**query, 'pivot': True})
+        unpivoted = self.dao.query_ents(query=query)
+        self.assertEqual(pivoted, unpivoted)
+        self.assertEqual(list(pivoted.keys()), list(unpivoted.keys()))
+        return pivoted
+
+    def test_pivots_props(self):
+        pivoted = self._assert_matches_unpivoted(query={})
+        self.assertEqual(len(pivoted), 6)
+        self.assertEqual(pivoted['ent_sans_idx']['props'], {'prop_0': 'x'})
+
+    def test_pivots_filtered_pages(self):
+        pivoted = self._assert_matches_unpivoted(query={
+            'prop_filters': [{'prop': 'idx', 'op': '>', 'arg': 0}],
+            'order_by': [{'prop': 'idx', 'type': 'int', 'desc': True}],
+            'limit': 3,
+        })
+        self.assertEqual(list(pivoted.keys()), ['ent_4', 'ent_3', 'ent_2'])
+
+    def test_iter_ents_pivots_props(self):
+        query = {'props_to_select': self.props_to_select}
+        self.assertEqual(
+            {ent['key']: ent for ent in
+             self.dao.iter_ents(query={**query, 'pivot': True})},
+            self.dao.query_ents(query=query)
+        )
+
+class IterEntsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i, 'props': {'idx': i, **self.props}}
+            for i in range(7)
+        ])
+        self.dao.create_ent(ent_key='ent_sans_props')
+
+    def test_yields_ents_by_key(self):
+        ents = list(self.dao.iter_ents(fetch_size=2))
+        expected = self.dao.query_ents()
+        self.assertEqual([ent['key'] for ent in ents], sorted(expected.keys()))
+        self.assertEqual({ent['key']: ent for ent in ents}, expected)
+
+    def test_yields_filtered_ents(self):
+        query = {'prop_filters': [{'prop': 'idx', 'op': '>=', 'arg': 4}],
+                 'props_to_select': ['idx']}
+        ents = list(self.dao.iter_ents(query=query, fetch_size=1))
+        self.assertEqual({ent['key']: ent for ent in ents},
+                         self.dao.query_ents(query=query))
+
+    def test_yields_ents_in_page_order(self):
+        query = {'order_by': [{'prop': 'idx', 'type': 'int', 'desc': True}],
+                 'limit': 3}
+        ents = list(self.dao.iter_ents(query=query, fetch_size=2))
+        self.assertEqual([ent['key'] for ent in ents],
+                         ['ent_6', 'ent_5', 'ent_4'])
+
+    def test_releases_connection_when_closed(self):
+        checked_out = []
+        _sqla.event.listen(self.dao.engine, 'checkout',
+                           lambda *args: checked_out.append(1))
+        _sqla.event.listen(self.dao.engine, 'checkin',
+                           lambda *args: checked_out.pop())
+        ents = self.dao.iter_ents(fetch_size=1)
+        next(ents)
+        self.assertEqual(checked_out, [1])
+        self.assertIsNone(self.dao.current_connection)
+        ents.close()
+        self.assertEqual(checked_out, [])
+
 class QueryEntsSansPropsTestCase(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -204,12 +1161,62 @@ class UpsertEntTestCase(BaseTestCase):
         self.assertEqual(fetched_ents[self.ent_key]['props'], self.props)
 
     def test_patches_if_exists(self):
-        self.dao.create_ent(ent_key=self.ent_key, props=self.props)
+        ent = self.dao.create_ent(ent_key=self.ent_key, props=self.props)
         prop_keys = list(self.props.keys())
         patches = {prop: '{prop}_new_value'.format(prop=prop)
                    for prop in prop_keys[:-1]}
         deletions = [prop_keys[-1]]
+        time.sleep(.002)
         self.dao.upsert_ent(ent_key=self.ent_key, patches=patches,
                             deletions=deletions)
         fetched_ents = self.dao.query_ents()
         self.assertEqual(fetched_ents[self.ent_key]['props'], patches)
+        self.assertGreater(fetched_ents[self.ent_key]['modified'],
+                           ent['modified'])
+
+    def test_upsert_ents(self):
+        self.dao.create_ent(ent_key=self.ent_key, props=self.props)
+        ent_keys = self.dao.upsert_ents(ents=[
+            {'key': self.ent_key, 'patches': {'prop_0': 'new_value',
+                                              'new_prop': 1},
+             'deletions': ['prop_1']},
+            {'key': 'new_ent_key', 'patches': self.props},
+            {'patches': {'prop_0': True}},
+        ], batch_size=2)
+        self.assertEqual(ent_keys[:2], [self.ent_key, 'new_ent_key'])
+        fetched_ents = self.dao.query_ents()
+        self.assertEqual(
+            {ent_key: fetched_ents[ent_key]['props'] for ent_key in ent_keys},
+            {
+                self.ent_key: {'prop_0': 'new_value', 'prop_2': 'value_2',
+                               'new_prop': 1},
+                'new_ent_key': self.props,
+                ent_keys[2]: {'prop_0': True},
+            }
+        )
+        self.assertEqual(self.dao.query_ents(query={'prop_filters': [
+            {'prop': 'new_prop', 'op': '=', 'arg': 1}]}).keys(),
+            {self.ent_key})
+
+    def test_merges_repeated_keys_in_order(self):
+        self.dao.create_ent(ent_key=self.ent_key, props=self.props)
+        ent_keys = self.dao.upsert_ents(ents=[
+            {'key': self.ent_key, 'patches': {'prop_0': 'a', 'prop_3': 'a'},
+             'deletions': ['prop_1']},
+            {'key': 'other_ent_key', 'patches': {'prop_0': 'b'}},
+            {'key': self.ent_key, 'patches': {'prop_1': 'c'},
+             'deletions': ['prop_3', 'prop_2']},
+            {'key': self.ent_key, 'patches': {'prop_0': 'd'}},
+        ])
+        self.assertEqual(ent_keys, [self.ent_key, 'other_ent_key',
+                                    self.ent_key, self.ent_key])
+        fetched_ents = self.dao.query_ents()
+        self.assertEqual(fetched_ents[self.ent_key]['props'],
+                         {'prop_0': 'd', 'prop_1': 'c'})
+        self.assertEqual(fetched_ents['other_ent_key']['props'],
+                         {'prop_0': 'b'})
+
+class GenericUpsertEntTestCase(UpsertEntTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dao.NATIVE_UPSERT_DIALECTS = []
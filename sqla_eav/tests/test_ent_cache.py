@@ -0,0 +1,84 @@
+import multiprocessing
+import unittest
+from unittest.mock import patch
+
+from .. import dao
+from .. import ent_cache
+
+class BaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dao = dao.Dao(db_uri='sqlite://')
+        self.dao.create_tables()
+        self.ents = self.dao.create_ents(
+            ents=[{'key': 'ent_%s' % i, 'props': {'idx': i}} for i in range(3)],
+            return_ents=True)
+        self.ent_cache = ent_cache.EntCache(dao=self.dao,
+                                            backend=self.generate_backend())
+        patcher = patch.object(self.dao, 'get_ents', wraps=self.dao.get_ents)
+        self.addCleanup(patcher.stop)
+        self.get_ents = patcher.start()
+
+    def generate_backend(self): return ent_cache.LRUBackend()
+
+    def _fetched_keys(self):
+        return [call[1]['keys'] for call in self.get_ents.call_args_list]
+
+class EntCacheTestCase(BaseTestCase):
+    def test_reads_through(self):
+        keys = ['ent_0', 'ent_1', 'missing']
+        self.assertEqual(self.ent_cache.get_ents(keys=keys),
+                         {key: self.ents[key] for key in keys[:2]})
+        self.assertEqual(self.ent_cache.get_ents(keys=keys[:2]),
+                         {key: self.ents[key] for key in keys[:2]})
+        self.assertEqual(self.ent_cache.get_ent(key='ent_2'),
+                         self.ents['ent_2'])
+        self.assertEqual(self._fetched_keys(), [keys, ['ent_2']])
+
+    def test_invalidates_on_writes_through_dao(self):
+        self.ent_cache.get_ent(key='ent_0')
+        self.dao.update_ent(ent_key='ent_0', patches={'idx': 10})
+        self.dao.upsert_ent(ent_key='ent_1', patches={'idx': 11})
+        self.assertEqual(self.ent_cache.get_ent(key='ent_0')['props'],
+                         {'idx': 10})
+        self.assertEqual(self._fetched_keys(), [['ent_0'], ['ent_0']])
+
+    def test_revalidates_against_modified(self):
+        self.ent_cache.get_ent(key='ent_0')
+        self.dao.execute_sql(
+            'UPDATE ents SET modified=modified + 1 WHERE key=:key',
+            params={'key': 'ent_0'}, rw_mode='w')
+        self.ent_cache.get_ent(key='ent_0')
+        self.assertEqual(self._fetched_keys(), [['ent_0'], ['ent_0']])
+
+    def test_returns_copies(self):
+        self.ent_cache.get_ent(key='ent_0')['props']['idx'] = 'mutated'
+        self.assertEqual(self.ent_cache.get_ent(key='ent_0'),
+                         self.ents['ent_0'])
+
+class SharedDictBackendTestCase(BaseTestCase):
+    def generate_backend(self):
+        self.shared_dict = {}
+        return ent_cache.SharedDictBackend(shared_dict=self.shared_dict)
+
+    def test_reads_through_shared_dict(self):
+        self.ent_cache.get_ent(key='ent_0')
+        self.assertEqual(list(self.shared_dict.keys()), ['ent_0'])
+        self.ent_cache.get_ent(key='ent_0')
+        self.assertEqual(self._fetched_keys(), [['ent_0']])
+
+    def test_expires_entries(self):
+        self.ent_cache.backend.ttl = -1
+        for i in range(2): self.ent_cache.get_ent(key='ent_0')
+        self.assertEqual(self._fetched_keys(), [['ent_0'], ['ent_0']])
+
+    def test_caches_offloaded_values_in_manager_dicts(self):
+        manager = multiprocessing.Manager()
+        self.addCleanup(manager.shutdown)
+        self.ent_cache.backend.shared_dict = manager.dict()
+        self.dao.blob_threshold = 100
+        doc = {'text': 'x' * 500}
+        self.dao.upsert_ent(ent_key='ent_0', patches={'doc': doc})
+        for i in range(2):
+            self.assertEqual(self.ent_cache.get_ent(key='ent_0')['props'],
+                             {'idx': 0, 'doc': doc})
+        self.assertEqual(self._fetched_keys(), [['ent_0']])
@@ -0,0 +1,78 @@
+import unittest
+
+from .. import dao
+
+class BaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dao = dao.Dao(db_uri='sqlite://')
+        self.dao.create_tables()
+        self.dao.create_ents(ents=[
+            {'key': 'ent_%s' % i,
+             'props': {'idx': i, 'parity': i % 2, 'flag': (i % 10 == 0),
+                       **({'rare': i} if i < 2 else {})}}
+            for i in range(20)
+        ])
+        self.filters = {
+            'idx': {'prop': 'idx', 'op': '=', 'arg': 3},
+            'parity': {'prop': 'parity', 'op': '=', 'arg': 1},
+            'rare': {'prop': 'rare', 'op': 'EXISTS'},
+            'flag': {'prop': 'flag', 'op': '! =', 'arg': True},
+        }
+
+    def _query_keys(self, query=None):
+        return sorted(self.dao.query_ents(query=query).keys())
+
+class AnalyzeTestCase(BaseTestCase):
+    def test_gathers_prop_stats(self):
+        self.assertEqual(self.dao.analyze(), {
+            'idx': {'rows': 20, 'distinct_values': 20},
+            'parity': {'rows': 20, 'distinct_values': 2},
+            'flag': {'rows': 20, 'distinct_values': 2},
+            'rare': {'rows': 2, 'distinct_values': 2},
+        })
+        self.assertEqual(self.dao.planner.ent_count, 20)
+
+    def test_clears_statement_cache(self):
+        self.dao.query_ents(query={'prop_filters': [self.filters['idx']]})
+        self.assertEqual(len(self.dao.statement_cache), 1)
+        self.dao.analyze()
+        self.assertEqual(len(self.dao.statement_cache), 0)
+
+class PlanTestCase(BaseTestCase):
+    def test_keeps_given_order_before_analyze(self):
+        prop_filters = [self.filters['parity'], self.filters['idx']]
+        plan = self.dao.plan_query(query={'prop_filters': prop_filters})
+        self.assertEqual(plan['strategy'], 'join')
+        self.assertEqual(plan['prop_filters'], prop_filters)
+
+    def test_orders_filters_by_estimated_rows(self):
+        self.dao.analyze()
+        plan = self.dao.plan_query(query={'prop_filters': [
+            self.filters['parity'], self.filters['flag'],
+            self.filters['idx']]})
+        self.assertEqual(plan['prop_filters'], [
+            self.filters['idx'], self.filters['parity'],
+            self.filters['flag']])
+        self.assertEqual(plan['estimated_rows'], [1, 10, 10])
+        self.assertEqual(plan['strategy'], 'join')
+
+    def test_intersects_when_no_filter_is_selective(self):
+        self.dao.analyze()
+        query = {'prop_filters': [self.filters['parity'],
+                                  self.filters['flag']]}
+        explanation = self.dao.explain(query=query)
+        self.assertEqual(explanation['strategy'], 'intersect')
+        self.assertIn('INTERSECT', explanation['sql'])
+        self.assertEqual(self._query_keys(query=query),
+                         sorted('ent_%s' % i for i in range(1, 20, 2)))
+
+    def test_plans_preserve_results(self):
+        queries = [
+            {'prop_filters': [self.filters[prop] for prop in props]}
+            for props in [['parity', 'rare'], ['flag', 'parity'],
+                          ['flag', 'parity', 'rare'], ['idx', 'parity']]
+        ]
+        unplanned = [self._query_keys(query=query) for query in queries]
+        self.dao.analyze()
+        self.assertEqual([self._query_keys(query=query) for query in queries],
+                         unplanned)
@@ -1,7 +1,17 @@
+import concurrent.futures
+import functools
 import json
+import multiprocessing
+import queue
+import threading
+import zlib
+
+from ..dao import is_in_memory_sqlite_url, iter_batches
 
 
 ACTION_TYPES = ['update_ent', 'upsert_ent']
+MERGEABLE_ACTION_PARAMS = {'ent_key', 'patches', 'deletions', 'ent_modified',
+                           'diff'}
 
 class InvalidActionError(Exception):
     def __init__(self, *args, action=None, **kwargs):
@@ -16,32 +26,248 @@ class DaoActionsWriter(object):
             self.validate_action(action=action)
             self.fh.write(json.dumps(action) + "\n")
 
-    def validate_action(self, action=None):
-        if action['type'] not in ACTION_TYPES:
-            raise InvalidActionError(action=action)
+    def validate_action(self, action=None): validate_action(action=action)
+
+def validate_action(action=None):
+    if action['type'] not in ACTION_TYPES:
+        raise InvalidActionError(action=action)
 
 def write_dao_actions(dao_actions=None, dest=None):
     with open(dest, 'w') as f:
         DaoActionsWriter(fh=f).write_actions(actions=dao_actions)
 
 class DaoActionProcessor(object):
-    def __init__(self, dao=None):
+    def __init__(self, dao=None, batch_size=None, collect_results=True,
+                 checkpoint=None):
         self.dao = dao
+        self.batch_size = batch_size
+        self.collect_results = collect_results
+        self.checkpoint = checkpoint
 
-    def process_action_files(self, action_files=None):
+    def process_action_files(self, action_files=None, workers=None,
+                             **parallel_kwargs):
+        if workers:
+            return self.process_action_files_in_parallel(
+                action_files=action_files, workers=workers, **parallel_kwargs)
         return [self.process_action_file(action_file=action_file)
                 for action_file in action_files]
 
-    def process_action_file(self, action_file=None):
-        actions = self.parse_action_file(action_file=action_file)
-        return self.process_actions(actions=actions)
+    def process_action_files_in_parallel(self, action_files=None, workers=None,
+                                         shard_by='ent_key',
+                                         use_processes=False, dao_factory=None,
+                                         progress=None, queue_size=1000):
+        # Sharding by ent_key keeps each key's actions in file order.
+        # shard_by='file' is only safe when no two files share an ent_key.
+        dao_factory = dao_factory or self.get_dao_factory()
+        # Workers report per-action errors instead of raising, so one bad
+        # action can't stall the other shards.
+        processor_kwargs = {'batch_size': self.batch_size or 1,
+                            'checkpoint': self.checkpoint}
+        executor_cls = (concurrent.futures.ProcessPoolExecutor if use_processes
+                        else concurrent.futures.ThreadPoolExecutor)
+        summary = {'processed': 0, 'errors': 0, 'failures': []}
+        with executor_cls(max_workers=workers, initializer=_init_worker,
+                          initargs=(dao_factory, processor_kwargs)) as executor:
+            if shard_by == 'file':
+                futures = [
+                    executor.submit(_process_action_file_in_worker,
+                                    action_file=action_file)
+                    for action_file in action_files
+                ]
+            elif shard_by == 'ent_key':
+                futures = self._submit_ent_key_shards(
+                    executor=executor, action_files=action_files,
+                    workers=workers, use_processes=use_processes,
+                    queue_size=queue_size)
+            else: raise ValueError("unknown shard_by '%s'" % shard_by)
+            for future in concurrent.futures.as_completed(futures):
+                worker_summary = future.result()
+                for key in ['processed', 'errors', 'failures']:
+                    summary[key] += worker_summary[key]
+                if progress: progress(summary)
+        return summary
+
+    def _submit_ent_key_shards(self, executor=None, action_files=None,
+                               workers=None, use_processes=False,
+                               queue_size=None):
+        if use_processes:
+            manager = multiprocessing.Manager()
+            action_queues = [manager.Queue(queue_size) for i in range(workers)]
+        else:
+            action_queues = [queue.Queue(queue_size) for i in range(workers)]
+        # Each shard is drained by one long-running task, so actions on an
+        # ent_key run in file order.
+        futures = [executor.submit(_process_action_queue_in_worker,
+                                   action_queue=action_queue)
+                   for action_queue in action_queues]
+        try:
+            for action_file in action_files:
+                for entry in self.iter_action_file(action_file=action_file):
+                    shard = self.get_action_shard(action=entry['action'],
+                                                  shards=workers)
+                    self._put_shard_item(action_queue=action_queues[shard],
+                                         future=futures[shard],
+                                         item=entry['action'])
+        finally:
+            for action_queue, future in zip(action_queues, futures):
+                self._put_shard_item(action_queue=action_queue, future=future,
+                                     item=None)
+        return futures
+
+    def _put_shard_item(self, action_queue=None, future=None, item=None):
+        while True:
+            try: return action_queue.put(item, timeout=1)
+            except queue.Full:
+                # A crashed worker would otherwise block the reader forever.
+                if future.done():
+                    future.result()
+                    return
+
+    def get_action_shard(self, action=None, shards=None):
+        ent_key = str(action.get('params', {}).get('ent_key'))
+        return zlib.crc32(ent_key.encode()) % shards
+
+    def get_dao_factory(self):
+        if is_in_memory_sqlite_url(url=self.dao.engine.url):
+            # Each worker's engine would open its own empty database.
+            raise ValueError("parallel processing needs a shared database,"
+                             " not in-memory sqlite")
+        return functools.partial(
+            _build_worker_dao, dao_cls=type(self.dao),
+            dao_kwargs=self.dao.get_clone_kwargs(),
+            value_compression_dict=self.dao.value_compression_dict)
+
+    def summarize_action_results(self, results=None):
+        summary = {'processed': 0, 'errors': 0, 'failures': []}
+        for result in results:
+            summary['processed'] += 1
+            if result['error'] is not None:
+                summary['errors'] += 1
+                summary['failures'].append({'action': result['action'],
+                                            'error': repr(result['error'])})
+        return summary
+
+    def process_action_file(self, action_file=None, offset=0):
+        entries = self.iter_action_file(action_file=action_file, offset=offset)
+        return self.process_action_entries(entries=entries,
+                                           action_file=action_file)
+
+    def iter_action_file(self, action_file=None, offset=0):
+        with open(action_file, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                offset += len(line)
+                if not line.strip(): continue
+                action = json.loads(line)
+                validate_action(action=action)
+                yield {'action': action, 'offset': offset}
 
     def parse_action_file(self, action_file=None):
-        with open(action_file) as f:
-            return [json.loads(line.strip()) for line in f]
+        return [entry['action']
+                for entry in self.iter_action_file(action_file=action_file)]
 
     def process_actions(self, actions=None):
-        return [self.execute_action(action=action) for action in actions]
+        return self.process_action_entries(
+            entries=({'action': action} for action in actions))
+
+    def process_action_entries(self, entries=None, action_file=None):
+        results = self.iter_action_entry_results(entries=entries,
+                                                 action_file=action_file)
+        if self.collect_results: return list(results)
+        counts = {'processed': 0, 'errors': 0}
+        for result in results:
+            counts['processed'] += 1
+            if isinstance(result, dict) and result.get('error') is not None:
+                counts['errors'] += 1
+        return counts
+
+    def iter_action_entry_results(self, entries=None, action_file=None):
+        if self.batch_size:
+            for batch in iter_batches(items=entries,
+                                      batch_size=self.batch_size):
+                results = self.process_action_batch(
+                    actions=[entry['action'] for entry in batch])
+                self.save_checkpoint(action_file=action_file, entry=batch[-1])
+                yield from results
+        else:
+            for entry in entries:
+                result = self.execute_action(action=entry['action'])
+                self.save_checkpoint(action_file=action_file, entry=entry)
+                yield result
+
+    def save_checkpoint(self, action_file=None, entry=None):
+        if self.checkpoint is None or 'offset' not in entry: return
+        self.checkpoint({'action_file': action_file, 'offset': entry['offset']})
+
+    def process_actions_in_batches(self, actions=None):
+        results = []
+        for batch in iter_batches(items=actions, batch_size=self.batch_size):
+            results.extend(self.process_action_batch(actions=batch))
+        return results
+
+    def process_action_batch(self, actions=None):
+        merged_actions = self.merge_actions(actions=actions)
+        results = []
+        try:
+            with self.dao.session(transactional=True):
+                for merged_action in merged_actions:
+                    result = self.execute_action(action=merged_action['action'])
+                    results.extend(
+                        {'action': action, 'result': result, 'error': None}
+                        for action in merged_action['actions']
+                    )
+        except Exception:
+            # Replay the batch one action per transaction, so that each
+            # failing action is reported without losing the others.
+            results = [self.process_action_in_transaction(action=action)
+                       for action in actions]
+        return results
+
+    def process_action_in_transaction(self, action=None):
+        try:
+            with self.dao.session(transactional=True):
+                result = self.execute_action(action=action)
+            return {'action': action, 'result': result, 'error': None}
+        except Exception as error:
+            return {'action': action, 'result': None, 'error': error}
+
+    def merge_actions(self, actions=None):
+        merged_actions = []
+        for action in actions:
+            if merged_actions and self.can_merge_actions(
+                action=merged_actions[-1]['action'], next_action=action):
+                merged_actions[-1]['action'] = self.merge_action_pair(
+                    action=merged_actions[-1]['action'], next_action=action)
+                merged_actions[-1]['actions'].append(action)
+            else: merged_actions.append({'action': action, 'actions': [action]})
+        return merged_actions
+
+    def can_merge_actions(self, action=None, next_action=None):
+        params = action.get('params', {})
+        next_params = next_action.get('params', {})
+        return (
+            action['type'] == next_action['type']
+            and params.get('ent_key') is not None
+            and params.get('ent_key') == next_params.get('ent_key')
+            and next_params.get('ent_modified') is None
+            and params.get('diff') == next_params.get('diff')
+            and set(params) <= MERGEABLE_ACTION_PARAMS
+            and set(next_params) <= MERGEABLE_ACTION_PARAMS
+        )
+
+    def merge_action_pair(self, action=None, next_action=None):
+        params = action.get('params', {})
+        next_params = next_action.get('params', {})
+        patches = dict(params.get('patches') or {})
+        deletions = list(params.get('deletions') or [])
+        for prop, value in (next_params.get('patches') or {}).items():
+            patches[prop] = value
+            if prop in deletions: deletions.remove(prop)
+        for prop in (next_params.get('deletions') or []):
+            patches.pop(prop, None)
+            if prop not in deletions: deletions.append(prop)
+        return {**action,
+                'params': {**params, 'patches': patches, 'deletions': deletions}}
 
     def execute_action(self, action=None):
         handler = self.get_action_handler(action=action)
@@ -50,9 +276,37 @@ class DaoActionProcessor(object):
     def get_action_handler(self, action=None):
         return getattr(self.dao, action['type'])
 
-def process_action_files(action_files=None, dao=None):
-    return DaoActionProcessor(dao=dao).process_action_files(
-        action_files=action_files)
+_worker_state = threading.local()
+
+def _build_worker_dao(dao_cls=None, dao_kwargs=None,
+                      value_compression_dict=None):
+    dao = dao_cls(**dao_kwargs)
+    dao.value_compression_dict = value_compression_dict
+    return dao
+
+def _init_worker(dao_factory=None, processor_kwargs=None):
+    # One dao, and so one engine, per worker thread or process.
+    _worker_state.processor = DaoActionProcessor(dao=dao_factory(),
+                                                 **processor_kwargs)
+
+def _process_action_file_in_worker(action_file=None):
+    processor = _worker_state.processor
+    return processor.summarize_action_results(
+        results=processor.iter_action_entry_results(
+            entries=processor.iter_action_file(action_file=action_file),
+            action_file=action_file)
+    )
+
+def _process_action_queue_in_worker(action_queue=None):
+    processor = _worker_state.processor
+    entries = ({'action': action} for action in iter(action_queue.get, None))
+    return processor.summarize_action_results(
+        results=processor.iter_action_entry_results(entries=entries))
+
+def process_action_files(action_files=None, dao=None, **processor_kwargs):
+    return DaoActionProcessor(dao=dao, **processor_kwargs)\
+            .process_action_files(action_files=action_files)
 
-def process_actions(actions=None, dao=None):
-    return DaoActionProcessor(dao=dao).process_actions(actions=actions)
+def process_actions(actions=None, dao=None, **processor_kwargs):
+    return DaoActionProcessor(dao=dao, **processor_kwargs)\
+            .process_actions(actions=actions)
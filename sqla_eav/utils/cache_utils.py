@@ -0,0 +1,56 @@
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try: value, expires_at = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._items[key]
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        expires_at = None
+        if self.ttl is not None: expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while self.max_size is not None and \
+                  len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key): return key in self._items
+
+    def __len__(self): return len(self._items)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try: return self._items.pop(key)[0]
+            except KeyError: return default
+
+    def clear(self):
+        with self._lock: self._items.clear()
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._items),
+                'max_size': self.max_size}
@@ -0,0 +1,50 @@
+import functools
+import zlib
+
+try: import zstandard as _zstd
+except ImportError: _zstd = None
+
+
+ENCODINGS = ['none', 'zlib', 'zstd']
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+def get_available_encodings():
+    return [encoding for encoding in ENCODINGS
+            if encoding != 'zstd' or _zstd is not None]
+
+def validate_encoding(encoding=None):
+    if encoding not in get_available_encodings():
+        raise Exception("encoding '{encoding}' is not available".format(
+            encoding=encoding))
+
+def compress(data=None, encoding=None, dictionary=None):
+    validate_encoding(encoding=encoding)
+    if encoding == 'zlib': return zlib.compress(data, ZLIB_LEVEL)
+    if encoding == 'zstd':
+        return _zstd.ZstdCompressor(
+            level=ZSTD_LEVEL, **_get_zstd_dict_kwargs(dictionary=dictionary)
+        ).compress(data)
+    return data
+
+def decompress(data=None, encoding=None, dictionary=None):
+    validate_encoding(encoding=encoding)
+    if encoding == 'zlib': return zlib.decompress(data)
+    if encoding == 'zstd':
+        return _zstd.ZstdDecompressor(
+            **_get_zstd_dict_kwargs(dictionary=dictionary)
+        ).decompress(data)
+    return data
+
+def train_dictionary(samples=None, dict_size=None):
+    validate_encoding(encoding='zstd')
+    return _zstd.train_dictionary(dict_size, list(samples)).as_bytes()
+
+def _get_zstd_dict_kwargs(dictionary=None):
+    if dictionary is None: return {}
+    return {'dict_data': _get_zstd_dict(dictionary)}
+
+@functools.lru_cache(maxsize=16)
+def _get_zstd_dict(dictionary=None):
+    # Parsing a dict is far costlier than a small value's (de)compression.
+    return _zstd.ZstdCompressionDict(dictionary)
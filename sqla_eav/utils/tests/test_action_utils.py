@@ -1,7 +1,14 @@
 import collections
+import itertools
+import json
+import os
+import tempfile
 import unittest
 from unittest.mock import call, MagicMock, patch
 
+import sqlalchemy as _sqla
+
+from ... import dao as _dao
 from .. import action_utils
 
 class UtilsBaseTestCase(unittest.TestCase):
@@ -45,38 +52,91 @@ class ProcessActionFilesTestCase(ActionProcessorBaseTestCase):
 class ProcessActionFileTestCase(ActionProcessorBaseTestCase):
     def setUp(self):
         super().setUp()
-        self.setup_action_processor_mocks(attrs=['parse_action_file',
-                                                 'process_actions'])
+        self.setup_action_processor_mocks(attrs=['iter_action_file',
+                                                 'process_action_entries'])
+        self.offset = MagicMock()
         self.result = self.action_processor.process_action_file(
-            action_file=self.action_file)
+            action_file=self.action_file, offset=self.offset)
 
-    def test_parses_action_file(self):
-        self.assertEqual(self.action_processor.parse_action_file.call_args,
-                         call(action_file=self.action_file))
+    def test_iterates_action_file(self):
+        self.assertEqual(self.action_processor.iter_action_file.call_args,
+                         call(action_file=self.action_file, offset=self.offset))
 
-    def test_processes_actions(self):
-        expected_actions = self.action_processor.parse_action_file.return_value
-        self.assertEqual(self.action_processor.process_actions.call_args,
-                         call(actions=expected_actions))
-        self.assertEqual(self.result,
-                         self.action_processor.process_actions.return_value)
+    def test_processes_action_entries(self):
+        expected_entries = self.action_processor.iter_action_file.return_value
+        self.assertEqual(
+            self.action_processor.process_action_entries.call_args,
+            call(entries=expected_entries, action_file=self.action_file))
+        self.assertEqual(
+            self.result,
+            self.action_processor.process_action_entries.return_value)
 
-class ParseActionFileTestCase(ActionProcessorBaseTestCase):
+class ActionFileBaseTestCase(ActionProcessorBaseTestCase):
     def setUp(self):
         super().setUp()
-        self.mocks = self.setup_module_mocks(attrs=['json', 'open'])
-        self.mock_lines = [MagicMock() for i in range(3)]
-        expected_fh = self.mocks['open'].return_value.__enter__.return_value
-        expected_fh.__iter__.return_value = self.mock_lines
-        self.result = self.action_processor.parse_action_file(
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.action_file = os.path.join(tmp_dir.name, 'actions.bulk')
+        self.actions = [
+            {'type': 'upsert_ent', 'params': {'ent_key': 'ent_%s' % i}}
+            for i in range(4)
+        ]
+        action_utils.write_dao_actions(dao_actions=self.actions,
+                                       dest=self.action_file)
+        with open(self.action_file, 'rb') as f:
+            self.line_offsets = list(itertools.accumulate(
+                len(line) for line in f))
+
+class IterActionFileTestCase(ActionFileBaseTestCase):
+    def test_yields_actions_with_offsets(self):
+        entries = list(self.action_processor.iter_action_file(
+            action_file=self.action_file))
+        self.assertEqual(entries, [
+            {'action': action, 'offset': offset}
+            for action, offset in zip(self.actions, self.line_offsets)
+        ])
+
+    def test_resumes_from_offset(self):
+        entries = list(self.action_processor.iter_action_file(
+            action_file=self.action_file, offset=self.line_offsets[1]))
+        self.assertEqual([entry['action'] for entry in entries],
+                         self.actions[2:])
+
+    def test_validates_actions(self):
+        with open(self.action_file, 'a') as f:
+            f.write(json.dumps({'type': 'bad_type'}) + "\n")
+        with self.assertRaises(action_utils.InvalidActionError):
+            list(self.action_processor.iter_action_file(
+                action_file=self.action_file))
+
+    def test_parse_action_file_returns_actions(self):
+        self.assertEqual(self.action_processor.parse_action_file(
+            action_file=self.action_file), self.actions)
+
+class ProcessActionFileCheckpointTestCase(ActionFileBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.checkpoints = []
+        self.action_processor.checkpoint = self.checkpoints.append
+        self.action_processor.collect_results = False
+
+    def test_checkpoints_after_each_action(self):
+        result = self.action_processor.process_action_file(
             action_file=self.action_file)
+        self.assertEqual(result, {'processed': 4, 'errors': 0})
+        self.assertEqual(self.checkpoints, [
+            {'action_file': self.action_file, 'offset': offset}
+            for offset in self.line_offsets
+        ])
 
-    def test_returns_deserialized_action_lines(self):
-        self.assertEqual(self.mocks['open'].call_args, call(self.action_file))
-        self.assertEqual(self.mocks['json'].loads.call_args_list,
-                         [call(line.strip()) for line in self.mock_lines])
-        self.assertEqual(self.result, [self.mocks['json'].loads.return_value
-                                       for line in self.mock_lines])
+    def test_checkpoints_after_each_batch(self):
+        self.action_processor.batch_size = 3
+        self.action_processor.process_action_file(
+            action_file=self.action_file)
+        self.assertEqual(self.checkpoints, [
+            {'action_file': self.action_file, 'offset': offset}
+            for offset in [self.line_offsets[2], self.line_offsets[3]]
+        ])
 
 class ProcessActionsTestCase(ActionProcessorBaseTestCase):
     def setUp(self):
@@ -95,6 +155,102 @@ class ProcessActionsTestCase(ActionProcessorBaseTestCase):
              for action in self.actions]
         )
 
+class ProcessActionsInBatchesTestCase(ActionProcessorBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.action_processor.batch_size = 2
+        self.setup_action_processor_mocks(attrs=['process_action_batch'])
+        self.action_processor.process_action_batch.side_effect = \
+                lambda actions=None: ['result_for_%s' % id(action)
+                                      for action in actions]
+        self.actions = [MagicMock() for i in range(5)]
+        self.result = self.action_processor.process_actions(
+            actions=iter(self.actions))
+
+    def test_processes_batches(self):
+        self.assertEqual(
+            self.action_processor.process_action_batch.call_args_list,
+            [call(actions=self.actions[i:i+2]) for i in range(0, 5, 2)]
+        )
+        self.assertEqual(self.result, ['result_for_%s' % id(action)
+                                       for action in self.actions])
+
+class ProcessActionBatchTestCase(ActionProcessorBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.setup_action_processor_mocks(attrs=['execute_action'])
+        self.actions = [
+            {'type': 'update_ent', 'params': {'ent_key': 'a',
+                                              'patches': {'p': 1}}},
+            {'type': 'update_ent', 'params': {'ent_key': 'a',
+                                              'patches': {'p': 2}}},
+            {'type': 'upsert_ent', 'params': {'ent_key': 'b'}},
+        ]
+
+    def test_executes_merged_actions_in_one_transaction(self):
+        result = self.action_processor.process_action_batch(
+            actions=self.actions)
+        self.assertEqual(self.dao.session.call_args_list,
+                         [call(transactional=True)])
+        self.assertEqual(
+            self.action_processor.execute_action.call_args_list,
+            [call(action={'type': 'update_ent',
+                          'params': {'ent_key': 'a', 'patches': {'p': 2},
+                                     'deletions': []}}),
+             call(action=self.actions[2])]
+        )
+        self.assertEqual(
+            result,
+            [{'action': action, 'error': None,
+              'result': self.action_processor.execute_action.return_value}
+             for action in self.actions]
+        )
+
+    def test_reports_errors_per_action(self):
+        error = Exception()
+        def execute_action(action=None):
+            if action['type'] == 'upsert_ent': raise error
+            return action['params']['patches']
+        self.action_processor.execute_action.side_effect = execute_action
+        result = self.action_processor.process_action_batch(
+            actions=self.actions)
+        self.assertEqual(len(self.dao.session.call_args_list), 4)
+        self.assertEqual(result, [
+            {'action': self.actions[0], 'result': {'p': 1}, 'error': None},
+            {'action': self.actions[1], 'result': {'p': 2}, 'error': None},
+            {'action': self.actions[2], 'result': None, 'error': error},
+        ])
+
+class MergeActionsTestCase(ActionProcessorBaseTestCase):
+    def _generate_action(self, type_='update_ent', **params):
+        return {'type': type_, 'params': {'ent_key': 'a', **params}}
+
+    def _merge_actions(self, actions=None):
+        return [merged_action['action'] for merged_action in
+                self.action_processor.merge_actions(actions=actions)]
+
+    def test_merges_patches_and_deletions(self):
+        actions = [
+            self._generate_action(patches={'p1': 1, 'p2': 1},
+                                  deletions=['p3']),
+            self._generate_action(patches={'p3': 2}, deletions=['p1']),
+            self._generate_action(patches={'p4': 3}),
+        ]
+        self.assertEqual(self._merge_actions(actions=actions), [
+            self._generate_action(patches={'p2': 1, 'p3': 2, 'p4': 3},
+                                  deletions=['p1'])
+        ])
+
+    def test_doesnt_merge_unmergeable_actions(self):
+        actions = [
+            self._generate_action(patches={'p1': 1}),
+            self._generate_action(type_='upsert_ent', patches={'p1': 2}),
+            self._generate_action(type_='upsert_ent', patches={'p1': 3},
+                                  ent_modified=123),
+            self._generate_action(type_='upsert_ent', ent_key='b'),
+        ]
+        self.assertEqual(self._merge_actions(actions=actions), actions)
+
 class ExecuteActionTestCase(ActionProcessorBaseTestCase):
     def setUp(self):
         super().setUp()
@@ -125,3 +281,111 @@ class GetActionHandlerTestCase(ActionProcessorBaseTestCase):
     def test_gets_handler_for_upsert_ent_action(self):
         result = self._get_action_handler(action_type='upsert_ent')
         self.assertEqual(result, self.action_processor.dao.upsert_ent)
+
+class ParallelProcessActionFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dao = _dao.Dao(db_uri='sqlite:///' + os.path.join(tmp_dir.name,
+                                                               'db.sqlite'))
+        self.dao.ensure_tables()
+        self.action_processor = action_utils.DaoActionProcessor(dao=self.dao)
+        self.action_files = []
+        self.expected_props = collections.defaultdict(dict)
+        for i in range(3):
+            actions = []
+            for j in range(10):
+                ent_key = 'ent_%s' % j
+                patches = {'file': i, 'prop_%s' % i: j}
+                actions.append({'type': 'upsert_ent',
+                                'params': {'ent_key': ent_key,
+                                           'patches': patches}})
+                self.expected_props[ent_key].update(patches)
+            action_file = os.path.join(tmp_dir.name, '%s.bulk' % i)
+            action_utils.write_dao_actions(dao_actions=actions,
+                                           dest=action_file)
+            self.action_files.append(action_file)
+
+    def _assert_props(self):
+        self.assertEqual(
+            {ent_key: ent['props']
+             for ent_key, ent in self.dao.query_ents().items()},
+            self.expected_props
+        )
+
+    def test_shards_by_ent_key(self):
+        progress = []
+        summary = self.action_processor.process_action_files(
+            action_files=self.action_files, workers=3, shard_by='ent_key',
+            progress=lambda summary: progress.append(summary['processed']))
+        self.assertEqual(summary, {'processed': 30, 'errors': 0,
+                                   'failures': []})
+        self.assertEqual(len(progress), 3)
+        self._assert_props()
+
+    def test_keeps_file_order_for_keys_shared_across_files(self):
+        # Earlier files are longer, so file-level parallelism would let
+        # them finish, and write, last.
+        ent_keys = ['k%s' % i for i in range(7)]
+        for i, action_file in enumerate(self.action_files):
+            actions = [
+                {'type': 'upsert_ent',
+                 'params': {'ent_key': ent_keys[j % len(ent_keys)],
+                            'patches': {'n': i * 1000 + j}}}
+                for j in range(len(ent_keys) * 10 ** (2 - i))
+            ]
+            action_utils.write_dao_actions(dao_actions=actions,
+                                           dest=action_file)
+        self.action_processor.process_action_files(
+            action_files=self.action_files, workers=4)
+        self.assertEqual(
+            {ent_key: ent['props']['n']
+             for ent_key, ent in self.dao.query_ents(
+                 query={'ent_filters': [{'col': 'key', 'op': 'IN',
+                                         'arg': ent_keys}]}
+             ).items()},
+            {ent_key: 2000 + j for j, ent_key in enumerate(ent_keys)}
+        )
+
+    def test_shards_by_file_across_processes(self):
+        summary = self.action_processor.process_action_files(
+            action_files=self.action_files[:1], workers=2, shard_by='file',
+            use_processes=True)
+        self.assertEqual(summary['processed'], 10)
+        self.expected_props = {
+            ent_key: {'file': 0, 'prop_0': props['prop_0']}
+            for ent_key, props in self.expected_props.items()
+        }
+        self._assert_props()
+
+    def test_builds_worker_daos_like_the_parent(self):
+        self.dao.value_compression = 'zlib'
+        action_utils.write_dao_actions(dao_actions=[
+            {'type': 'upsert_ent', 'params': {'ent_key': 'ent_text',
+                                              'patches': {'text': 'x' * 500}}}
+        ], dest=self.action_files[0])
+        self.action_processor.process_action_files(
+            action_files=self.action_files[:1], workers=2)
+        props_table = self.dao.schema['tables']['props']
+        self.assertEqual(self.dao.execute(
+            _sqla.select([props_table.c.value_encoding])
+            .where(props_table.c.prop == 'text')).scalar(), 'zlib')
+        self.assertEqual(self.dao.get_ent(key='ent_text')['props'],
+                         {'text': 'x' * 500})
+
+    def test_rejects_in_memory_sqlite(self):
+        action_processor = action_utils.DaoActionProcessor(
+            dao=_dao.Dao(db_uri='sqlite://'))
+        with self.assertRaises(ValueError):
+            action_processor.process_action_files(
+                action_files=self.action_files, workers=2)
+
+    def test_aggregates_failures(self):
+        bad_action = {'type': 'update_ent', 'params': {'ent_key': 'ent_0'}}
+        action_utils.write_dao_actions(dao_actions=[bad_action],
+                                       dest=self.action_files[0])
+        summary = self.action_processor.process_action_files(
+            action_files=self.action_files, workers=2, shard_by='ent_key')
+        self.assertEqual(summary['processed'], 21)
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['failures'][0]['action'], bad_action)
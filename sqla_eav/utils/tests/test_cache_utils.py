@@ -0,0 +1,25 @@
+import unittest
+
+from .. import cache_utils
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache_utils.LRUCache(max_size=2)
+
+    def test_evicts_least_recently_used(self):
+        self.cache['a'] = 1
+        self.cache['b'] = 2
+        self.cache.get('a')
+        self.cache['c'] = 3
+        self.assertEqual([self.cache.get(key) for key in 'abc'],
+                         [1, None, 3])
+
+    def test_tracks_stats(self):
+        self.cache['a'] = 1
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache['b'] = 2
+        self.cache['c'] = 3
+        self.assertEqual(self.cache.get_stats(),
+                         {'hits': 1, 'misses': 1, 'evictions': 1, 'size': 2,
+                          'max_size': 2})
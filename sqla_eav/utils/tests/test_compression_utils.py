@@ -0,0 +1,17 @@
+import unittest
+
+from .. import compression_utils
+
+class CompressionTestCase(unittest.TestCase):
+    def test_round_trips_available_encodings(self):
+        data = b'{"text": "' + b'x' * 1000 + b'"}'
+        for encoding in compression_utils.get_available_encodings():
+            compressed = compression_utils.compress(data=data,
+                                                    encoding=encoding)
+            if encoding != 'none': self.assertLess(len(compressed), len(data))
+            self.assertEqual(compression_utils.decompress(
+                data=compressed, encoding=encoding), data)
+
+    def test_rejects_unknown_encodings(self):
+        with self.assertRaises(Exception):
+            compression_utils.compress(data=b'', encoding='some_encoding')